@@ -0,0 +1,505 @@
+#!/usr/bin/env python3
+"Benchmarks for the slow stages, run against throwaway databases full of synthetic faces"
+import argparse, json, os, subprocess, sys, tempfile, time
+import numpy as np
+
+def synthetic_encodings(count, people=None, seed=0):
+    """Make count random 128-d encodings in clusters, one cluster per person, spaced so
+    that faces of one person are about 0.4 apart and different people well over 1.0"""
+    rng = np.random.default_rng(seed)
+    if people is None: people = max(1, count // 20)
+    centres = rng.normal(0, 0.1, (people, 128))
+    labels = rng.integers(0, people, count)
+    return centres[labels] + rng.normal(0, 0.025, (count, 128)), labels
+
+def scratch_db():
+    "Point core at a new empty database in a temporary folder, and return that folder"
+    folder = tempfile.mkdtemp(prefix="photo-face-bench-")
+    os.environ["PHOTO_FACE_DB"] = os.path.join(folder, "faces.db")
+    import core
+    core.init(overwrite=True)
+    return folder
+
+def synthetic_images(folder, count, size=96, seed=0):
+    "Write count small random JPEGs (blocks of colour, not faces) into folder"
+    from PIL import Image, ImageDraw
+    rng = np.random.default_rng(seed)
+    os.makedirs(folder, exist_ok=True)
+    for i in range(count):
+        im = Image.new("RGB", (size, size), tuple(rng.integers(0, 256, 3).tolist()))
+        draw = ImageDraw.Draw(im)
+        for j in range(4):
+            x, y = rng.integers(0, size, 2).tolist()
+            draw.rectangle([x, y, x + size // 4, y + size // 4], fill=tuple(rng.integers(0, 256, 3).tolist()))
+        im.save(os.path.join(folder, "{:07d}.jpg".format(i)), quality=80)
+
+def insert_faces(encodings):
+    import core
+    db = core.get_db()
+    db.executemany("insert into faces (image, x, y, w, h, encoding) values (0, 0, 0, 10, 10, ?)",
+        ((core.encode_encoding(e),) for e in encodings))
+    db.commit()
+
+def bench_pair(faces=500, threshold=0.6):
+    "Pairs per second for the old pairs-table path and the vectorised path"
+    import core
+    encodings, labels = synthetic_encodings(faces)
+    total_pairs = faces * (faces - 1) // 2
+    results = {}
+
+    scratch_db()
+    insert_faces(encodings)
+    start = time.time()
+    core.insert_empty_pairs()
+    while core.pair_faces_in_blocks()[0]: pass
+    elapsed = time.time() - start
+    results["blocks"] = {"seconds": elapsed, "pairs_per_sec": total_pairs / elapsed}
+
+    scratch_db()
+    insert_faces(encodings)
+    start = time.time()
+    for done, total, stored in core.pair_faces_vectorised(threshold): pass
+    elapsed = time.time() - start
+    results["vectorised"] = {"seconds": elapsed, "pairs_per_sec": total_pairs / elapsed, "stored": stored}
+    return {"benchmark": "pair", "faces": faces, "pairs": total_pairs, "results": results}
+
+def bench_index(faces=20000, queries=200, k=10, radius=0.5, lists=0):
+    "Recall and speed of the nearest-neighbour index against brute force, at a range of nprobe settings"
+    import core, faceindex
+    encodings, labels = synthetic_encodings(faces)
+    ids = np.arange(1, faces + 1)
+    rng = np.random.default_rng(1)
+    probes = encodings[rng.choice(faces, queries, replace=False)] + rng.normal(0, 0.025, (queries, 128))
+
+    start = time.time()
+    d2 = faceindex.squared_distances(probes, encodings)
+    nearest = [set(ids[np.argsort(row)[:k]].tolist()) for row in d2]
+    within = [set(ids[row <= radius * radius].tolist()) for row in d2]
+    brute_seconds = time.time() - start
+    start = time.time()
+    brute_pairs = set()
+    for done, face1s, face2s, distances in core.iter_close_pairs(ids, encodings, radius):
+        brute_pairs.update(zip(face1s.tolist(), face2s.tolist()))
+    brute_pairs_seconds = time.time() - start
+
+    start = time.time()
+    index = faceindex.FaceIndex.build(ids, encodings, lists or None)
+    results = {"build_seconds": time.time() - start, "lists": len(index.centroids),
+        "brute_force": {"queries_per_sec": 2 * queries / brute_seconds, "all_pairs_seconds": brute_pairs_seconds},
+        "nprobe": {}}
+    for nprobe in [1, 2, 4, 8, 16, 32, 64, None]:
+        start = time.time()
+        knn_found = 0
+        radius_found = 0
+        for probe, expected_near, expected_within in zip(probes, nearest, within):
+            if nprobe is not None:
+                knn_found += len(expected_near & set(index.search(probe, k, nprobe)[0].tolist()))
+            radius_found += len(expected_within & set(index.radius(probe, radius, nprobe)[0].tolist()))
+        seconds = time.time() - start
+        start = time.time()
+        pairs = set()
+        for done, face1s, face2s, distances in index.close_pairs(radius, nprobe):
+            pairs.update(zip(face1s.tolist(), face2s.tolist()))
+        results["nprobe"][str(nprobe or "exact")] = {
+            "queries_per_sec": (queries if nprobe is None else 2 * queries) / seconds,
+            "knn_recall": None if nprobe is None else knn_found / float(k * queries),
+            "radius_recall": radius_found / float(max(1, sum(len(w) for w in within))),
+            "all_pairs_seconds": time.time() - start,
+            "all_pairs_recall": len(pairs & brute_pairs) / float(max(1, len(brute_pairs)))}
+    return {"benchmark": "index", "faces": faces, "results": results}
+
+def sample_images(folder, images):
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(folder):
+        paths.extend(os.path.join(dirpath, f) for f in sorted(filenames) if f.lower().endswith((".jpg", ".png")))
+        if len(paths) >= images: break
+    return paths[:images]
+
+def bench_load(folder="", images=20):
+    "Per-stage time for reading, hashing, decoding and thumbnailing images, before and after the single-read path"
+    import core, face_recognition, hashlib, mimetypes
+    from gi.repository import GLib, GnomeDesktop
+    paths = sample_images(folder, images)
+    tf = GnomeDesktop.DesktopThumbnailFactory.new(GnomeDesktop.DesktopThumbnailSize.NORMAL)
+    stages = {"separate_reads": {"decode": 0.0, "md5": 0.0, "thumbnail": 0.0, "size": 0.0},
+        "single_read": {"read": 0.0, "md5": 0.0, "decode": 0.0, "thumbnail": 0.0}}
+    for path in paths:
+        # thumbnails are generated but not saved, so both paths always do the work
+        old = stages["separate_reads"]
+        start = time.time()
+        face_recognition.load_image_file(path)
+        old["decode"] += time.time() - start
+        start = time.time()
+        md5 = hashlib.md5()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(4096), b""): md5.update(chunk)
+        old["md5"] += time.time() - start
+        start = time.time()
+        tf.generate_thumbnail(GLib.filename_to_uri(path), mimetypes.guess_type(path)[0])
+        old["thumbnail"] += time.time() - start
+        start = time.time()
+        core.Image.open(path).size
+        old["size"] += time.time() - start
+
+        new = stages["single_read"]
+        start = time.time()
+        with open(path, "rb") as f: data = f.read()
+        new["read"] += time.time() - start
+        start = time.time()
+        hashlib.md5(data).hexdigest()
+        new["md5"] += time.time() - start
+        start = time.time()
+        pixels, size = core.decode_image(data)
+        new["decode"] += time.time() - start
+        start = time.time()
+        core.pixbuf_from_pixels(pixels)
+        new["thumbnail"] += time.time() - start
+    for timings in stages.values():
+        timings["total"] = sum(timings.values())
+        timings["images_per_sec"] = len(paths) / timings["total"] if timings["total"] else None
+    return {"benchmark": "load", "images": len(paths), "seconds": stages}
+
+def overlap(a, b):
+    "Intersection over union of two (top, right, bottom, left) boxes"
+    height = min(a[2], b[2]) - max(a[0], b[0])
+    width = min(a[1], b[1]) - max(a[3], b[3])
+    if height <= 0 or width <= 0: return 0.0
+    area = lambda box: (box[2] - box[0]) * (box[1] - box[3])
+    return height * width / float(area(a) + area(b) - height * width)
+
+def bench_detect(folder="", images=20, megapixels="0,4,2,1,0.5"):
+    """Throughput and detection recall at each detection resolution (0 is full size); recall is the
+    share of faces found at full size that are also found, overlapping by half, at that size"""
+    import core, face_recognition
+    paths = sample_images(folder, images)
+    data = [core.read_image(path)[0] for path in paths]
+    results = {}
+    baseline = None
+    for mp in [float(x) for x in megapixels.split(",")]:
+        max_pixels = int(mp * 1000000) or None
+        found = []
+        start = time.time()
+        for d in data:
+            pixels, size = core.decode_image(d, max_pixels)
+            detect = core.shrink_pixels(pixels, max_pixels)
+            locations = face_recognition.face_locations(detect)
+            found.append(core.scale_locations(locations, (detect.shape[1], detect.shape[0]), size))
+        elapsed = time.time() - start
+        if baseline is None: baseline = found
+        expected = sum(len(b) for b in baseline)
+        matched = sum(1 for want, got in zip(baseline, found) for w in want if any(overlap(w, g) >= 0.5 for g in got))
+        results[str(mp or "full")] = {"images_per_sec": len(data) / elapsed, "faces": sum(len(f) for f in found),
+            "recall": matched / float(expected) if expected else None}
+    return {"benchmark": "detect", "images": len(data), "results": results}
+
+def bench_encode(folder="", images=20, batches="1,16,64,256", detect_megapixels=1.0):
+    """Faces encoded per second by face_recognition.face_encodings, one call per image, and by
+    the batched encoder at each batch size, on the faces found in some real photos; also the
+    largest difference between the two paths' encodings, which should be about zero"""
+    import core, face_recognition
+    paths = sample_images(folder, images)
+    max_pixels = int(detect_megapixels * 1000000) or None
+    pictures = []
+    for path in paths:
+        pixels, size = core.decode_image(core.read_image(path)[0], max_pixels)
+        pictures.append((pixels, face_recognition.face_locations(pixels)))
+    faces = sum(len(locations) for pixels, locations in pictures)
+    if not faces: return {"benchmark": "encode", "images": len(paths), "faces": 0}
+    start = time.time()
+    per_image = [e for pixels, locations in pictures
+        for e in face_recognition.face_encodings(pixels, known_face_locations=locations)]
+    results = {"per_image": {"faces_per_sec": faces / (time.time() - start)}}
+    for size in [int(x) for x in batches.split(",")]:
+        start = time.time()
+        chips = [chip for pixels, locations in pictures for chip in core.face_chips(pixels, locations)]
+        chip_seconds = time.time() - start
+        encodings = core.encode_chips(chips, size)
+        elapsed = time.time() - start
+        results["batch_" + str(size)] = {"faces_per_sec": faces / elapsed, "chip_seconds": chip_seconds,
+            "max_difference": float(np.max(np.abs(np.array(encodings) - np.array(per_image))))}
+    return {"benchmark": "encode", "images": len(paths), "faces": faces, "results": results}
+
+def bench_identify(groups="1000,10000", faces_per_group=8, exemplars=3, queries=500):
+    "Latency of naming one face against the group centroids, for each number of groups"
+    import faceindex
+    results = {}
+    for count in [int(x) for x in groups.split(",")]:
+        encodings, labels = synthetic_encodings(count * faces_per_group, people=count)
+        start = time.time()
+        centroids = faceindex.GroupCentroids.build(encodings, labels, exemplars)
+        build_seconds = time.time() - start
+        rng = np.random.default_rng(1)
+        picks = rng.choice(len(encodings), queries)
+        probes = encodings[picks] + rng.normal(0, 0.025, (queries, 128))
+        timings = []
+        correct = 0
+        for probe, label in zip(probes, labels[picks]):
+            start = time.time()
+            groupids, distances = centroids.nearest(probe, 5)
+            timings.append(time.time() - start)
+            correct += groupids[0] == label
+        timings.sort()
+        results[str(count)] = {"build_seconds": build_seconds,
+            "mean_ms": 1000 * sum(timings) / len(timings), "p95_ms": 1000 * timings[int(0.95 * (len(timings) - 1))],
+            "top1_accuracy": correct / float(queries)}
+    return {"benchmark": "identify", "results": results}
+
+def bench_group(faces=100000, per_person=20, distances="0.45,0.5,0.55,0.4"):
+    """Time to build the merge tree once, to group by cutting it the first time, and then to
+    regroup at each distance in turn, against regrouping from scratch with union-find; faces
+    are in groups of per_person, with close pairs at random distances up to 0.6, as pairing
+    would store them"""
+    import core
+    scratch_db()
+    rng = np.random.default_rng(0)
+    db = core.get_db()
+    db.executemany("insert into faces (id, image, x, y, w, h, encoding, paired) values (?, 0, 0, 0, 10, 10, x'', 1)",
+        ((i,) for i in range(1, faces + 1)))
+    first = np.arange(1, faces + 1, per_person)
+    i, j = np.triu_indices(per_person, 1)
+    face1s = (first[:, None] + i[None, :]).ravel()
+    face2s = (first[:, None] + j[None, :]).ravel()
+    keep = face2s <= faces
+    face1s, face2s = face1s[keep], face2s[keep]
+    db.executemany("insert into pairs (face1, face2, distance, grouped) values (?, ?, ?, 0)",
+        zip(face1s.tolist(), face2s.tolist(), rng.uniform(0.3, 0.6, len(face1s)).tolist()))
+    db.commit()
+    results = {"pairs": len(face1s)}
+    start = time.time()
+    core.load_merge_tree()
+    results["build_seconds"] = time.time() - start
+    distances = [float(x) for x in distances.split(",")]
+    start = time.time()
+    core.group_faces_by_cut(distances[0])
+    results["first_cut_seconds"] = time.time() - start
+    for distance in distances:
+        start = time.time()
+        grouped, groups = core.group_faces_by_cut(distance)
+        results[str(distance)] = {"cut_seconds": time.time() - start, "groups": groups}
+    for distance in distances:
+        db.execute("delete from faces2groups")
+        db.execute("delete from groups")
+        db.execute("update pairs set grouped = 0")
+        db.commit()
+        start = time.time()
+        core.group_faces_union_find(distance)
+        results[str(distance)]["union_find_seconds"] = time.time() - start
+    return {"benchmark": "group", "faces": faces, "results": results}
+
+def bench_import(files=100000, per_folder=200, threads=16):
+    """Time to read the names of files images in a tree of folders of per_folder each, with the
+    old serial os.walk and a row dict per file, and with the parallel scan and batched inserts;
+    and to import a synthetic Shotwell library of the same photos"""
+    import core, sqlite3
+    folder = scratch_db()
+    tree = os.path.join(folder, "tree")
+    paths = []
+    for i in range(files):
+        subfolder = os.path.join(tree, "{:04d}".format(i // per_folder // 50), "{:04d}".format(i // per_folder))
+        if i % per_folder == 0: os.makedirs(subfolder)
+        paths.append(os.path.join(subfolder, "{}.jpg".format(i)))
+        open(paths[-1], "w").close()
+    results = {}
+
+    start = time.time()
+    db = core.get_db()
+    c = db.cursor()
+    def walk():
+        for dirpath, dirname, filenames in os.walk(tree):
+            for f in filenames:
+                if f.lower().endswith(".jpg") or f.lower().endswith(".png"):
+                    full_path = os.path.abspath(os.path.join(dirpath, f))
+                    st = os.stat(full_path)
+                    yield core.new_image_row(full_path, f, st.st_mtime, st.st_size)
+    for rows in core.chunks(walk(), 1000):
+        core.insert_images(c, rows)
+    db.commit()
+    results["walk"] = {"seconds": time.time() - start}
+
+    for name, load in [("scan", lambda: core.load_from_folder(tree)),
+            ("shotwell", lambda: core.load_from_shotwell(os.path.join(folder, "photo.db"), threads))]:
+        if name == "shotwell":
+            shotwell = sqlite3.connect(os.path.join(folder, "photo.db"))
+            shotwell.execute("create table PhotoTable (id integer primary key, filename text, width int, height int, md5 text)")
+            shotwell.executemany("insert into PhotoTable (filename, width, height, md5) values (?, 4000, 3000, ?)",
+                ((p, "{:032x}".format(i)) for i, p in enumerate(paths)))
+            shotwell.commit()
+            shotwell.close()
+        core.init(overwrite=True)
+        start = time.time()
+        count = load()
+        results[name] = {"seconds": time.time() - start, "images": count}
+    for name in results:
+        results[name]["files_per_sec"] = files / results[name]["seconds"]
+    return {"benchmark": "import", "files": files, "results": results}
+
+def bench_sql(faces=300, images=5000):
+    """Time each stage's queries on a synthetic library, with the database untuned and without the
+    stage indexes (a fresh connection per call, as before) and then as it is now"""
+    import core, sqlite3
+    encodings, labels = synthetic_encodings(faces)
+    tuning = core.DB_PRAGMAS
+    shared_db = core.get_db
+    results = {}
+    for setting in ["before", "after"]:
+        core.DB_PRAGMAS = tuning if setting == "after" else []
+        folder = scratch_db()
+        db = core.get_db()
+        if setting == "before":
+            for name in ["idx_faces_image", "idx_faces_unpaired", "idx_images_pending", "idx_pairs_distance",
+                    "idx_faces2groups_face", "idx_faces2groups_groupid", "idx_pairs_face2"]:
+                db.execute("drop index " + name)
+            db.commit()
+        if setting == "before":
+            core.get_db = lambda: sqlite3.connect(core.get_data_file())
+        def stage(fn):
+            start = time.time()
+            fn()
+            return time.time() - start
+        timings = {}
+        def read_folder():
+            for rows in core.chunks((core.new_image_row("/photos/{}.jpg".format(i), "{}.jpg".format(i), 0, 0)
+                    for i in range(images)), 1000):
+                db = core.get_db()
+                core.insert_images(db.cursor(), rows)
+                db.commit()
+        timings["read-folder"] = stage(read_folder)
+        def parse():
+            # write fake analysis results the way the pipeline does, a block at a time
+            for start in range(0, images, 24):
+                db = core.get_db()
+                c = db.cursor()
+                c.execute("select id, full_path from images where facecount is null limit 24")
+                results = [(image_id, [], [], "md5", "thumbnail", 100, 100, [], {}, None) for image_id, path in c.fetchall()]
+                if start == 0:
+                    results[0] = (results[0][0], [(0, 10, 10, 0)] * faces, list(encodings), "md5", "thumbnail", 100, 100, [], {}, None)
+                core.store_analysis_results(c, results)
+                db.commit()
+        timings["parse-images"] = stage(parse)
+        def pair():
+            core.insert_empty_pairs()
+            while core.pair_faces_in_blocks()[0]: pass
+        timings["pair"] = stage(pair)
+        def group():
+            while core.group_faces_in_blocks()[0]: pass
+        timings["group"] = stage(group)
+        timings["best-face"] = stage(core.find_best_faces)
+        timings["gallery"] = stage(lambda: core.simple_gallery(os.path.join(folder, "gallery.html")))
+        results[setting] = timings
+        core.get_db = shared_db
+    core.DB_PRAGMAS = tuning
+    return {"benchmark": "sql", "faces": faces, "images": images, "seconds": results}
+
+# runs a script and then reports which heavy modules it loaded and its peak memory; VmHWM is used
+# because ru_maxrss carries over the parent's peak through fork and exec
+STARTUP_PROBE = """import atexit, json, runpy, sys
+def report():
+    heavy = ["numpy", "PIL.Image", "gi", "face_recognition", "dlib"]
+    loaded = [m for m in heavy if m in sys.modules and type(sys.modules[m]).__name__ != "_LazyModule"]
+    peak = [int(line.split()[1]) for line in open("/proc/self/status") if line.startswith("VmHWM:")][0]
+    print(json.dumps({"loaded": loaded, "peak_rss_mb": peak / 1024.0}), file=sys.stderr)
+atexit.register(report)
+sys.argv = sys.argv[1:]
+runpy.run_path(sys.argv[0], run_name="__main__")
+"""
+
+def bench_startup(commands="help;read-folder {folder};best-face;gallery {folder}/gallery.html;paged-gallery {folder}/pages;rename-group a b",
+        images=20, repeat=3):
+    """Wall time and peak memory of running each llcli.py command, separated by semicolons, in a
+    new process against a small scratch library; {folder} is the library's folder. Also which
+    of the heavy modules each one actually loaded. The best of repeat runs is kept."""
+    folder = scratch_db()
+    synthetic_images(folder, images)
+    here = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+    for command in commands.split(";"):
+        args = command.format(folder=folder).split()
+        best = None
+        for i in range(repeat):
+            start = time.time()
+            child = subprocess.Popen([sys.executable, "-c", STARTUP_PROBE, "llcli.py"] + args, cwd=here,
+                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            stderr = child.communicate()[1]
+            run = {"seconds": time.time() - start, "returncode": child.returncode}
+            run.update(json.loads(stderr.decode("utf-8").strip().splitlines()[-1]))
+            if best is None or run["seconds"] < best["seconds"]: best = run
+        results[command.split()[0]] = best
+    return {"benchmark": "startup", "results": results}
+
+def database_bytes():
+    import core
+    return sum(os.path.getsize(f) for f in [core.get_data_file(), core.get_data_file() + "-wal"] if os.path.exists(f))
+
+def run_pipeline(faces, images):
+    "Time each stage of the pipeline for one library size, in this process"
+    import core
+    folder = scratch_db()
+    stages = {}
+    def stage(name, items, fn):
+        start = time.time()
+        fn()
+        seconds = time.time() - start
+        stages[name] = {"seconds": seconds, "items": items, "per_sec": items / seconds if seconds else None,
+            "peak_rss_mb": core.peak_rss_mb(), "db_bytes": database_bytes()}
+    if images:
+        synthetic_images(os.path.join(folder, "photos"), images)
+        stage("read-folder", images, lambda: core.load_from_folder(os.path.join(folder, "photos")))
+        stage("parse-images", images, lambda: list(core.analyse_images()))
+    encodings, labels = synthetic_encodings(faces)
+    def store_faces():
+        # one face per image, written through the same path as parse-images' results
+        db = core.get_db()
+        c = db.cursor()
+        for start in range(0, faces, 1000):
+            rows = [core.new_image_row("/synthetic/{}.jpg".format(i), "{}.jpg".format(i), 0, 0)
+                for i in range(start, min(faces, start + 1000))]
+            core.insert_images(c, rows)
+            c.execute("select id from images where substr(full_path, 1, 11) = '/synthetic/' and facecount is null")
+            ids = [x[0] for x in c.fetchall()]
+            core.store_analysis_results(c, [(image_id, [(0, 60, 60, 0)], [encoding], "md5", "", 100, 100, [], {}, None)
+                for image_id, encoding in zip(ids, encodings[start:])])
+            db.commit()
+    stage("store-faces", faces, store_faces)
+    stage("pair", faces, lambda: list(core.pair_faces_vectorised()))
+    stage("group", faces, core.group_faces_union_find)
+    stage("best-face", faces, core.find_best_faces)
+    stage("gallery", faces, lambda: core.simple_gallery(os.path.join(folder, "gallery.html")))
+    stage("paged-gallery", faces, lambda: core.paged_gallery(os.path.join(folder, "gallery")))
+    return stages
+
+def bench_pipeline(sizes="1000,10000,100000", images=200, output="", isolate="yes"):
+    """Time every stage of the pipeline on synthetic libraries of each size (in faces), reporting
+    throughput, peak memory and database size. Synthetic images, which have no faces, are used to
+    time reading and analysing; the face stages use clustered synthetic encodings. Each size runs
+    in its own process so that memory peaks are per size."""
+    import platform
+    results = {}
+    for size in [int(x) for x in sizes.split(",")]:
+        if isolate == "yes":
+            child = subprocess.run([sys.executable, os.path.abspath(__file__), "pipeline", "--sizes", str(size),
+                "--images", str(images), "--isolate", "no"], stdout=subprocess.PIPE, check=True)
+            results[str(size)] = json.loads(child.stdout.decode("utf-8"))["sizes"][str(size)]
+        else:
+            results[str(size)] = run_pipeline(size, images)
+    report = {"benchmark": "pipeline", "python": platform.python_version(), "numpy": np.__version__,
+        "time": time.time(), "images": images, "sizes": results}
+    if output:
+        with open(output, "w") as fp:
+            json.dump(report, fp, indent=2)
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Photo face tagger benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark")
+    benches = dict([(x[6:].replace("_", "-"), globals()[x]) for x in globals().keys() if x.startswith("bench_")])
+    for name, fn in sorted(benches.items()):
+        p = subparsers.add_parser(name, help=fn.__doc__)
+        argnames = fn.__code__.co_varnames[:fn.__code__.co_argcount]
+        for a, default in zip(argnames, fn.__defaults__ or ()):
+            p.add_argument("--" + a.replace("_", "-"), dest=a, default=default, type=type(default))
+    args = dict(parser.parse_args()._get_kwargs())
+    name = args.pop("benchmark")
+    if name is None:
+        parser.print_help()
+        sys.exit()
+    print(json.dumps(globals()["bench_" + name.replace("-", "_")](**args), indent=2))
@@ -1,28 +1,56 @@
 "Core functions"
-import gi
-gi.require_version('GnomeDesktop', '3.0')
-from gi.repository import GLib, Gio, GnomeDesktop
 import os
+import sys
+import atexit
+import collections
+import importlib.util
+import inspect
 import json
+import resource
 import tempfile
 import logging
 logging.basicConfig(level=logging.INFO)
 import copy
 import mimetypes
 import sqlite3
+import threading
+import time
 from multiprocessing import Pool, TimeoutError
 import hashlib
+import html
+import io
+import functools
 import itertools
-import numpy as np
 import base64
+import concurrent.futures
 import random
-from PIL import Image
-import face_recognition
+import urllib.parse
+
+def lazy_import(name):
+    """Import a module, but don't actually load it until something in it is first used, so
+    commands that never need it don't wait for it. face_recognition (which loads dlib's models)
+    and GnomeDesktop are heavier still, and are imported only in the functions that use them."""
+    if name in sys.modules: return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+np = lazy_import("numpy")
+Image = lazy_import("PIL.Image")
+import cropstore
+import resultcache
 
 class WontOverwriteError(Exception): pass
 
 def get_data_file():
-    folder = os.path.join(GLib.get_user_cache_dir(), "photo-face-tagger")
+    override = os.environ.get("PHOTO_FACE_DB")
+    if override: return override
+    # where GLib.get_user_cache_dir() would say, without loading GLib to ask it
+    cache = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    folder = os.path.join(cache, "photo-face-tagger")
     filepath = os.path.join(folder, "faces.db")
     try:
         os.makedirs(folder)
@@ -30,16 +58,112 @@ def get_data_file():
         pass
     return filepath
 
+def get_sidecar_file(suffix):
+    "Path for a file that lives alongside the database, like faces.index.npz"
+    return os.path.splitext(get_data_file())[0] + suffix
+
+# Each entry is a list of statements taking the schema from version N to N+1;
+# the version is kept in sqlite's user_version
+SCHEMA_UPGRADES = [
+    # 1: faces_version counts changes to faces, so side-car copies of the encodings know when they're stale
+    ["create table meta (key text primary key, value int)",
+     "insert into meta (key, value) values ('faces_version', 0)",
+     """create trigger faces_inserted after insert on faces
+        begin update meta set value = value + 1 where key = 'faces_version'; end""",
+     """create trigger faces_deleted after delete on faces
+        begin update meta set value = value + 1 where key = 'faces_version'; end""",
+     """create trigger faces_updated after update of encoding on faces
+        begin update meta set value = value + 1 where key = 'faces_version'; end"""],
+    # 2: change detection for sync_folder, and which faces have been paired
+    ["alter table images add column mtime real",
+     "alter table images add column size int",
+     "alter table faces add column paired int not null default 0",
+     "update faces set paired = 1 where exists (select 1 from pairs)"],
+    # 3: indexes for grouping one face at a time
+    ["create index idx_faces2groups_face on faces2groups (face)",
+     "create index idx_faces2groups_groupid on faces2groups (groupid)",
+     "create index idx_pairs_face2 on pairs (face2)"],
+    # 4: groups_version counts changes to group membership, for the side-car group centroids
+    ["insert into meta (key, value) values ('groups_version', 0)",
+     """create trigger faces2groups_inserted after insert on faces2groups
+        begin update meta set value = value + 1 where key = 'groups_version'; end""",
+     """create trigger faces2groups_deleted after delete on faces2groups
+        begin update meta set value = value + 1 where key = 'groups_version'; end""",
+     """create trigger faces2groups_updated after update on faces2groups
+        begin update meta set value = value + 1 where key = 'groups_version'; end"""],
+    # 5: each face's position among the faces of its image, which with the image's md5 keys its crop
+    ["alter table faces add column image_index int",
+     """update faces set image_index = (select count(*) from faces f2
+        where f2.image = faces.image and f2.id < faces.id)"""],
+    # 6: indexes for the queries each stage runs over and over
+    ["create index idx_faces_image on faces (image)",
+     "create index idx_faces_unpaired on faces (id) where paired = 0",
+     "create index idx_images_pending on images (id) where md5 is null",
+     "create index idx_pairs_distance on pairs (distance, grouped)"],
+    # 7: pairs_version counts pairs removed or re-measured; with max(rowid), which goes up as pairs
+    # are added, it tells the side-car merge tree when it's stale
+    ["insert into meta (key, value) values ('pairs_version', 0)",
+     """create trigger pairs_deleted after delete on pairs
+        begin update meta set value = value + 1 where key = 'pairs_version'; end""",
+     """create trigger pairs_updated after update of distance on pairs
+        begin update meta set value = value + 1 where key = 'pairs_version'; end"""],
+    # 8: images still to be analysed are the ones with no facecount, since imports can know the md5
+    ["drop index idx_images_pending",
+     "create index idx_images_pending on images (id) where facecount is null"],
+]
+
+def upgrade_schema(db):
+    "Bring an older database up to the current schema; a new empty one is left for init()"
+    version = db.execute("pragma user_version").fetchone()[0]
+    if version >= len(SCHEMA_UPGRADES): return
+    if not db.execute("select 1 from sqlite_master where type='table' and name='images'").fetchone(): return
+    for number in range(version, len(SCHEMA_UPGRADES)):
+        for sql in SCHEMA_UPGRADES[number]:
+            db.execute(sql)
+        db.execute("pragma user_version = {}".format(number + 1))
+    db.commit()
+
+# WAL lets readers carry on while a block is being written, and makes synchronous=normal
+# safe (a power cut can lose the last few commits, but not corrupt anything)
+DB_PRAGMAS = [
+    "pragma journal_mode = wal",
+    "pragma synchronous = normal",
+    "pragma cache_size = -65536", # 64MB
+    "pragma mmap_size = 268435456", # 256MB
+    "pragma temp_store = memory",
+]
+
+_connections = {}
+
 def get_db():
-    conn = sqlite3.connect(get_data_file())
+    """The connection to the database, shared by everything in this process so that sqlite's
+    page cache and prepared statements are reused; other processes, like analysis workers,
+    get their own"""
+    key = (os.getpid(), get_data_file())
+    conn = _connections.get(key)
+    if conn is None:
+        conn = sqlite3.connect(key[1], cached_statements=256)
+        for pragma in DB_PRAGMAS:
+            conn.execute(pragma)
+        upgrade_schema(conn)
+        _connections[key] = conn
     return conn
 
+@atexit.register
+def close_db():
+    "Close this process's connections; the next get_db() opens a new one"
+    for key in list(_connections):
+        if key[0] == os.getpid():
+            _connections.pop(key).close()
+
 def init(overwrite=False):
     dbf = get_data_file()
     if os.path.exists(dbf) and not overwrite:
         raise WontOverwriteError("There already is a data file; remove it.")
-    if os.path.exists(dbf):
-        os.unlink(dbf)
+    close_db()
+    for f in [dbf, dbf + "-wal", dbf + "-shm"]:
+        if os.path.exists(f):
+            os.unlink(f)
     db = get_db()
     c = db.cursor()
     c.execute("""CREATE TABLE images (id integer primary key, 
@@ -47,44 +171,326 @@ def init(overwrite=False):
         facecount int, width int, height int)""")
     c.execute("""CREATE UNIQUE INDEX idx_full_path ON images (full_path)""")
     c.execute("""CREATE TABLE faces (id integer primary key, 
-        image int, x int, y int, w int, h int, encoding text)""")
+        image int, x int, y int, w int, h int, encoding blob)""")
     c.execute("""CREATE TABLE pairs (face1 int, face2 int, distance real, grouped int)""")
     c.execute("""CREATE UNIQUE INDEX idx_pairs ON pairs (face1, face2)""")
     c.execute("""CREATE TABLE groups (id integer primary key, name text, best_face int)""")
     c.execute("""CREATE TABLE faces2groups (face int, groupid int)""")
     db.commit()
+    upgrade_schema(db)
+
+def peak_rss_mb():
+    "The most memory this process, or any finished worker it waited for, has used"
+    ours = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(ours, children) / 1024.0 # ru_maxrss is in kilobytes on Linux
+
+class Metrics:
+    """Timers and counters for working out where the time goes on a long run. Anything can
+    add_time() or count() under a name; report() gives the totals so far, with a rate and an
+    ETA if it's told how far through a stage we are, and appends them as one JSON line to the
+    log, if open_log() has been called. Cheap enough to be left on all the time."""
+    def __init__(self):
+        self.log = None
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self.stages = {}
+        self.seconds = collections.defaultdict(float)
+        self.counts = collections.defaultdict(int)
+
+    def add_time(self, name, seconds, count=1):
+        self.seconds[name] += seconds
+        self.counts[name] += count
 
+    def count(self, name, n=1):
+        self.counts[name] += n
+
+    def start(self, stage):
+        "Mark when a stage began, so report() can work out its rate and ETA"
+        self.stages[stage] = time.time()
+
+    def timer(self, name):
+        return _Timer(self, name)
+
+    def open_log(self, path):
+        self.log = open(path, "a")
+
+    def report(self, stage, done=None, total=None):
+        elapsed = time.time() - self.stages.get(stage, self.started)
+        record = {"time": time.time(), "stage": stage, "elapsed": round(elapsed, 3),
+            "peak_rss_mb": round(peak_rss_mb(), 1)}
+        if done is not None:
+            record["done"] = done
+            record["per_second"] = round(done / elapsed, 3) if elapsed else None
+            if total is not None:
+                record["total"] = total
+                record["eta"] = round((total - done) * elapsed / done, 1) if done else None
+        record["seconds"] = dict((k, round(v, 4)) for k, v in sorted(self.seconds.items()))
+        record["counts"] = dict(sorted(self.counts.items()))
+        if self.log:
+            self.log.write(json.dumps(record) + "\n")
+            self.log.flush()
+        return record
+
+class _Timer:
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.metrics.add_time(self.name, time.perf_counter() - self.start)
+
+metrics = Metrics()
+
+def timed(fn):
+    """Record the time spent in fn, and how often it's called, in metrics under its name.
+    For generators only the time spent inside the generator counts, not the caller's
+    time between items."""
+    name = fn.__name__
+    if inspect.isgeneratorfunction(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            gen = fn(*args, **kwargs)
+            metrics.count(name)
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(gen)
+                except StopIteration:
+                    return
+                finally:
+                    metrics.add_time(name, time.perf_counter() - start, count=0)
+                yield item
+        return wrapper
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            metrics.add_time(name, time.perf_counter() - start)
+    return wrapper
+
+def format_eta(seconds):
+    if seconds is None: return "unknown"
+    seconds = int(seconds)
+    return "{}:{:02d}:{:02d}".format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".tif", ".tiff", ".bmp")
+
+def scan_directory(path):
+    "The images directly in one directory, as (full_path, filename, mtime, size), and its subdirectories"
+    images = []
+    subdirectories = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirectories.append(entry.path)
+                elif entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                    st = entry.stat()
+                    images.append((entry.path, entry.name, st.st_mtime, st.st_size))
+    except OSError as e:
+        logging.warning("Couldn't read %s: %s", path, e)
+    return images, subdirectories
+
+def scan_folder(folder, threads=16):
+    """Yield (full_path, filename, mtime, size) for each image in folder and its subfolders.
+    Directories are read by a pool of threads at once, since on big trees (and network storage)
+    the time goes on waiting for the filesystem."""
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        waiting = set([executor.submit(scan_directory, os.path.abspath(folder))])
+        while waiting:
+            done, waiting = concurrent.futures.wait(waiting, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                images, subdirectories = future.result()
+                waiting.update(executor.submit(scan_directory, d) for d in subdirectories)
+                for image in images:
+                    yield image
+
+def new_image_row(full_path, filename, mtime, size):
+    return {
+        "id": None,
+        "full_path": full_path,
+        "filename": filename,
+        "md5": None,
+        "thumbnail": None,
+        "facecount": None,
+        "mtime": mtime,
+        "size": size
+    }
+
+def insert_images(c, rows):
+    c.executemany("""INSERT OR IGNORE INTO images 
+        (id, full_path, filename, md5, thumbnail, facecount, mtime, size) VALUES 
+        (:id, :full_path, :filename, :md5, :thumbnail, :facecount, :mtime, :size)""", rows)
+
+@timed
 def load_from_folder(folder):
     db = get_db()
     c = db.cursor()
     count = 0
-    for dirpath, dirname, filenames in os.walk(folder):
-        images = [x for x in filenames if x.lower().endswith(".jpg") or x.lower().endswith(".png")]
-        full_images = [{
-            "id": None,
-            "full_path": os.path.abspath(os.path.join(dirpath, f)), 
-            "filename": f,
-            "md5": None,
-            "thumbnail": None,
-            "facecount": None
-        } for f in images]
-        if full_images:
-            c.executemany("""INSERT OR IGNORE INTO images 
-                (id, full_path, filename, md5, thumbnail, facecount) VALUES 
-                (:id, :full_path, :filename, :md5, :thumbnail, :facecount)""", full_images)
-            count += len(full_images)
+    for rows in chunks(scan_folder(folder), 10000):
+        c.executemany("""INSERT OR IGNORE INTO images (full_path, filename, mtime, size)
+            VALUES (?, ?, ?, ?)""", rows)
+        count += len(rows)
     db.commit()
     return count
 
-def create_thumbnail(file_path):
-    "Guaranteed to return a valid image url; if it can't make a thumbnail it returns the original"
+def get_shotwell_file():
+    data = os.environ.get("XDG_DATA_HOME") or os.path.join(os.path.expanduser("~"), ".local", "share")
+    return os.path.join(data, "shotwell", "data", "photo.db")
+
+def get_shotwell_thumbnails():
+    "Shotwell's 128px thumbnails, by photo id, from wherever this version of Shotwell keeps them"
+    cache = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    thumbnails = {}
+    for folder in [os.path.join(os.path.expanduser("~"), ".shotwell", "thumbs", "thumbs128"),
+            os.path.join(cache, "shotwell", "thumbs", "thumbs128")]:
+        if not os.path.isdir(folder): continue
+        for name in os.listdir(folder):
+            # named thumb<photo id as 16 hex digits>.jpg
+            if name.startswith("thumb") and name.endswith(".jpg"):
+                try:
+                    thumbnails[int(name[5:-4], 16)] = os.path.join(folder, name)
+                except ValueError:
+                    pass
+    return thumbnails
+
+def stat_images(paths):
+    "(mtime, size) of each path, or None if it's gone"
+    out = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            out.append((st.st_mtime, st.st_size))
+        except OSError:
+            out.append(None)
+    return out
+
+@timed
+def load_from_shotwell(shotwell_file=None, threads=16):
+    """Read the photos in a Shotwell library, taking their size, md5 and thumbnail from Shotwell
+    rather than working them out again; the photos still need analysing for faces. Photos
+    that have gone missing are left out, and the files are stat()ed (a block at a time, by a
+    pool of threads) so that sync_folder sees them as unchanged. Returns how many were read."""
+    shotwell = sqlite3.connect("file:{}?mode=ro".format(urllib.parse.quote(shotwell_file or get_shotwell_file())), uri=True)
+    photos = [row for row in shotwell.execute("select id, filename, width, height, md5 from PhotoTable")
+        if row[1] and row[1].lower().endswith(IMAGE_EXTENSIONS)]
+    shotwell.close()
+    thumbnails = get_shotwell_thumbnails()
+    db = get_db()
+    c = db.cursor()
+    count = 0
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        blocks = list(chunks(photos, 1000))
+        for block, stats in zip(blocks, executor.map(stat_images, [[p[1] for p in b] for b in blocks])):
+            rows = [(filename, os.path.basename(filename), md5 or None, thumbnails.get(photo_id), width or None,
+                height or None, st[0], st[1]) for (photo_id, filename, width, height, md5), st in zip(block, stats) if st]
+            c.executemany("""INSERT OR IGNORE INTO images (full_path, filename, md5, thumbnail, width, height, mtime, size)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)""", rows)
+            count += len(rows)
+    db.commit()
+    return count
+
+def chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk: return
+        yield chunk
+
+def forget_faces_of_images(c, image_ids):
+    """Remove the faces found in these images, along with their pairs and group memberships.
+    Unnamed groups left with fewer than two faces are removed; named ones are kept, even if empty."""
+    c.execute("create temp table if not exists forgotten_faces (id integer primary key)")
+    c.execute("delete from forgotten_faces")
+    c.executemany("insert into forgotten_faces select id from faces where image = ?", ((i,) for i in image_ids))
+    c.execute("""delete from pairs where face1 in (select id from forgotten_faces)
+        or face2 in (select id from forgotten_faces)""")
+    c.execute("delete from faces2groups where face in (select id from forgotten_faces)")
+    c.execute("""delete from faces2groups where groupid in (
+        select f2g.groupid from faces2groups f2g inner join groups g on f2g.groupid = g.id
+        where g.name is null group by f2g.groupid having count(*) < 2)""")
+    c.execute("delete from groups where name is null and id not in (select groupid from faces2groups)")
+    c.execute("update groups set best_face = null where best_face in (select id from forgotten_faces)")
+    c.execute("delete from faces where id in (select id from forgotten_faces)")
+
+@timed
+def sync_folder(folder):
+    """Bring the images from folder up to date without starting again. New files are added,
+    files whose mtime or size has changed are reset so they get analysed again, and files
+    that have gone are removed along with their faces. Unchanged files aren't read at all.
+    Images from before mtime and size were recorded just get them recorded, rather than being
+    taken as changed. Returns (added, changed, removed)."""
+    db = get_db()
+    c = db.cursor()
+    prefix = os.path.join(os.path.abspath(folder), "")
+    c.execute("select full_path, id, mtime, size from images where substr(full_path, 1, ?) = ?",
+        (len(prefix), prefix))
+    known = dict((row[0], row[1:]) for row in c.fetchall())
+    added = []
+    changed = []
+    unrecorded = []
+    for full_path, filename, mtime, size in scan_folder(folder):
+        existing = known.pop(full_path, None)
+        if existing is None:
+            added.append(new_image_row(full_path, filename, mtime, size))
+        elif existing[1:] == (None, None):
+            unrecorded.append({"id": existing[0], "mtime": mtime, "size": size})
+        elif existing[1:] != (mtime, size):
+            changed.append({"id": existing[0], "mtime": mtime, "size": size})
+    removed = [existing[0] for existing in known.values()]
+    forget_faces_of_images(c, [x["id"] for x in changed] + removed)
+    c.executemany("delete from images where id = ?", ((i,) for i in removed))
+    c.executemany("""update images set md5=null, thumbnail=null, facecount=null, width=null, height=null,
+        mtime=:mtime, size=:size where id=:id""", changed)
+    c.executemany("update images set mtime=:mtime, size=:size where id=:id", unrecorded)
+    for rows in chunks(added, 1000):
+        insert_images(c, rows)
+    db.commit()
+    return len(added), len(changed), len(removed)
+
+THUMBNAIL_SIZE = 128 # freedesktop "normal" thumbnails fit in 128x128
+
+def gnome_desktop():
+    "(GLib, GnomeDesktop, GdkPixbuf), which only the thumbnail step needs"
+    import gi
+    gi.require_version('GnomeDesktop', '3.0')
+    gi.require_version('GdkPixbuf', '2.0')
+    from gi.repository import GLib, GnomeDesktop, GdkPixbuf
+    return GLib, GnomeDesktop, GdkPixbuf
+
+def pixbuf_from_pixels(pixels, size=THUMBNAIL_SIZE):
+    "Shrink an already-decoded RGB array to fit in size x size, as a pixbuf"
+    GLib, GnomeDesktop, GdkPixbuf = gnome_desktop()
+    im = Image.fromarray(pixels)
+    im.thumbnail((size, size))
+    return GdkPixbuf.Pixbuf.new_from_bytes(GLib.Bytes.new(im.tobytes()),
+        GdkPixbuf.Colorspace.RGB, False, 8, im.size[0], im.size[1], im.size[0] * 3)
+
+def create_thumbnail(file_path, pixels=None):
+    """Guaranteed to return a valid image url; if it can't make a thumbnail it returns the original.
+    If the image has already been decoded, pass its pixels so it isn't decoded again."""
+    GLib, GnomeDesktop, GdkPixbuf = gnome_desktop()
     tf = GnomeDesktop.DesktopThumbnailFactory.new(GnomeDesktop.DesktopThumbnailSize.NORMAL)
-    logging.debug("Creating new thumbnail for %s", file_path)
     main_image_url = GLib.filename_to_uri(file_path)
-    mimetype, encoding = mimetypes.guess_type(file_path)
-    thumbnail_pixbuf = tf.generate_thumbnail(main_image_url, mimetype)
+    mtime = os.path.getmtime(file_path)
+    existing = tf.lookup(main_image_url, mtime)
+    if existing:
+        return existing, True
+    logging.debug("Creating new thumbnail for %s", file_path)
+    if pixels is not None:
+        thumbnail_pixbuf = pixbuf_from_pixels(pixels)
+    else:
+        mimetype, encoding = mimetypes.guess_type(file_path)
+        thumbnail_pixbuf = tf.generate_thumbnail(main_image_url, mimetype)
     if thumbnail_pixbuf:
-        mtime = os.path.getmtime(file_path)
         tf.save_thumbnail(thumbnail_pixbuf, main_image_url, mtime)
         image_url = tf.lookup(main_image_url, mtime)
         logging.debug("Created new thumbnail for %s", file_path)
@@ -95,19 +501,283 @@ def create_thumbnail(file_path):
 def get_md5(fname):
     hash_md5 = hashlib.md5()
     with open(fname, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
             hash_md5.update(chunk)
     return hash_md5.hexdigest()
 
-def load_single(image):
-    image_id, full_path = image
-    frim = face_recognition.load_image_file(full_path)
-    locations = face_recognition.face_locations(frim)
+def read_image(full_path):
+    "Read an image file in one go, returning its bytes and their md5"
+    with open(full_path, "rb") as f:
+        data = f.read()
+    return data, hashlib.md5(data).hexdigest()
+
+def decode_image(data, max_pixels=None):
+    """Decode image bytes to an RGB array, as face_recognition.load_image_file does with a filename,
+    and return it with the image's full (width, height). If max_pixels is given, JPEGs bigger than
+    that are decoded in draft mode, at 1/2, 1/4 or 1/8 scale, which is much quicker; the result is
+    still at least max_pixels, so it may need shrinking further with shrink_pixels."""
+    im = Image.open(io.BytesIO(data))
+    size = im.size
+    if max_pixels and size[0] * size[1] > max_pixels:
+        scale = (float(max_pixels) / (size[0] * size[1])) ** 0.5
+        im.draft("RGB", (int(size[0] * scale), int(size[1] * scale)))
+    return np.array(im.convert("RGB")), size
+
+def shrink_pixels(pixels, max_pixels=None):
+    "Resize an RGB array down to about max_pixels, if it's bigger"
+    height, width = pixels.shape[:2]
+    if not max_pixels or width * height <= max_pixels: return pixels
+    scale = (float(max_pixels) / (width * height)) ** 0.5
+    size = (max(1, int(width * scale)), max(1, int(height * scale)))
+    return np.array(Image.fromarray(pixels).resize(size, Image.BILINEAR))
+
+def scale_locations(locations, from_size, to_size):
+    "Map face_recognition (top, right, bottom, left) locations from an image of one (width, height) to another"
+    if tuple(from_size) == tuple(to_size): return locations
+    sx = float(to_size[0]) / from_size[0]
+    sy = float(to_size[1]) / from_size[1]
+    return [(int(round(top * sy)), min(to_size[0], int(round(right * sx))),
+        min(to_size[1], int(round(bottom * sy))), int(round(left * sx)))
+        for top, right, bottom, left in locations]
+
+CROP_SIZE = 400 # the labelling UI shows faces in a 400x400 box
+
+def get_result_cache_file(database=None):
+    "The result cache for a database, shared by every database in the same folder unless PHOTO_FACE_CACHE points somewhere else"
+    return os.environ.get("PHOTO_FACE_CACHE") or os.path.join(os.path.dirname(database or get_data_file()), "analysis-cache.db")
+
+def get_result_cache(settings=""):
+    "The cache of analysis results made with settings (see analysis_settings)"
+    return resultcache.ResultCache(get_result_cache_file(), settings)
+
+def analysis_settings(detect_pixels=None, model="hog"):
+    "What decides which faces analysis finds in a photo, as a key for the result cache"
+    return "{}:{}".format(model, detect_pixels or 0)
+
+QUICK_HASH_BLOCK = 65536
+
+def hash_ends(size, head, tail):
+    h = hashlib.md5(str(size).encode("ascii"))
+    h.update(head)
+    h.update(tail)
+    return h.hexdigest()
+
+def quick_hash(full_path, size, block=QUICK_HASH_BLOCK):
+    "A hash of a file's size and its first and last blocks; files that differ in it can't be the same"
+    with open(full_path, "rb") as f:
+        head = f.read(block)
+        tail = b""
+        if size > block:
+            f.seek(max(block, size - block))
+            tail = f.read(block)
+    return hash_ends(size, head, tail)
+
+def quick_hash_data(data, block=QUICK_HASH_BLOCK):
+    "quick_hash of a file whose bytes have already been read"
+    tail = data[max(block, len(data) - block):] if len(data) > block else b""
+    return hash_ends(len(data), data[:block], tail)
+
+def with_sizes(images):
+    """(id, full_path, size, ...) images with the size filled in where it isn't known, which
+    split_duplicates needs; files that can't be found are left out, and stay to be analysed"""
+    for image in images:
+        if image[2] is None:
+            try:
+                image = image[:2] + (os.path.getsize(image[1]),) + image[3:]
+            except OSError as e:
+                logging.warning("Skipping %s for now: %s", image[1], e)
+                continue
+        yield image
+
+def split_duplicates(images, cache):
+    """Sort (id, full_path, size, md5 if known, ...) images into ones that need analysing, ones whose
+    results are in the cache, and copies of another image in the list. Unless the md5 is known,
+    only files whose size matches another one's get their first and last blocks read, and only
+    ones whose blocks match too are hashed in full. Returns (images to analyse,
+    [(image, md5)] in the cache, {image id: [its copies]})."""
+    sizes = collections.Counter(image[2] for image in images)
+    cached_sizes = cache.sizes()
+    prehashes = {}
+    for image in images:
+        if image[3] is None and (sizes[image[2]] > 1 or image[2] in cached_sizes):
+            prehashes[image[0]] = quick_hash(image[1], image[2])
+    counts = collections.Counter(prehashes.values())
+    analyse = []
+    cached = []
+    copies = {}
+    first = {}
+    for image in images:
+        md5 = image[3]
+        if md5 is None:
+            prehash = prehashes.get(image[0])
+            if prehash is None or (counts[prehash] == 1 and not cache.has_prehash(prehash)):
+                analyse.append(image)
+                continue
+            md5 = get_md5(image[1])
+        if cache.has(md5):
+            cached.append((image, md5))
+        elif md5 in first:
+            copies.setdefault(first[md5], []).append(image)
+        else:
+            first[md5] = image[0]
+            analyse.append(image)
+    return analyse, cached, copies
+
+def get_crop_store():
+    return cropstore.CropStore(get_sidecar_file(".crop-packs"))
+
+def make_face_crops(pixels, locations, size=CROP_SIZE):
+    "JPEG bytes of each face in an RGB array, shrunk if need be to fit in size x size"
+    im = Image.fromarray(pixels)
+    crops = []
+    for top, right, bottom, left in locations:
+        crop = im.crop((left, top, right, bottom))
+        crop.thumbnail((size, size))
+        out = io.BytesIO()
+        crop.save(out, "JPEG", quality=85)
+        crops.append(out.getvalue())
+    return crops
+
+class Laps:
+    "Times one stage after another of the work on an image; call it with each stage's name as it finishes"
+    def __init__(self):
+        self.timings = {}
+        self.clock = time.perf_counter()
+
+    def __call__(self, stage):
+        now = time.perf_counter()
+        self.add(stage, now - self.clock)
+        self.clock = now
+
+    def add(self, stage, seconds):
+        "Charge time to a stage directly, like this image's share of work done on several at once"
+        self.timings[stage] = self.timings.get(stage, 0.0) + seconds
+        self.clock = time.perf_counter()
+
+def read_and_decode(full_path, detect_pixels, laps):
+    """Read and decode an image only once; the hash, size and thumbnail all come from that.
+    Returns (md5, prehash, pixels, full size, pixels to detect faces in); the prehash is
+    quick_hash's, for the result cache."""
+    with open(full_path, "rb") as f:
+        data = f.read()
+    laps("read")
+    md5 = hashlib.md5(data).hexdigest()
+    prehash = quick_hash_data(data)
+    laps("md5")
+    frim, size = decode_image(data, detect_pixels)
+    del data
+    detect = shrink_pixels(frim, detect_pixels)
+    laps("decode")
+    return md5, prehash, frim, size, detect
+
+def finish_image(image, md5, prehash, frim, size, locations, encodings, laps):
+    """Make the thumbnail and crops of an analysed image, and the result analyse_images stores.
+    An image can come with a thumbnail, from an import, as (id, full_path, thumbnail)."""
+    image_id, full_path = image[:2]
+    thumbnail = image[2] if len(image) > 2 else None
+    if not thumbnail:
+        thumbnail, success = create_thumbnail(full_path, frim)
+    laps("thumbnail")
+    crops = make_face_crops(frim, locations)
+    laps("crops")
+    locations = scale_locations(locations, (frim.shape[1], frim.shape[0]), size)
+    return (image_id, locations, encodings, md5, thumbnail, size[0], size[1], crops, laps.timings, prehash)
+
+def load_single(image, detect_pixels=None):
+    # With detect_pixels, faces are found in a copy shrunk to about that many pixels and then
+    # encoded from the (draft-decoded, so possibly still reduced) image; locations are
+    # returned in the coordinates of the original image either way.
+    # Each stage's time is returned, in seconds, so the parent can add it to metrics.
+    import face_recognition
+    laps = Laps()
+    md5, prehash, frim, size, detect = read_and_decode(image[1], detect_pixels, laps)
+    locations = face_recognition.face_locations(detect)
+    locations = scale_locations(locations, (detect.shape[1], detect.shape[0]), (frim.shape[1], frim.shape[0]))
+    laps("detect")
     encodings = face_recognition.face_encodings(frim, known_face_locations=locations)
-    md5 = get_md5(full_path)
-    thumbnail, success = create_thumbnail(full_path)
-    im = Image.open(full_path)
-    return (image_id, locations, encodings, md5, thumbnail, im.size[0], im.size[1])
+    laps("encode")
+    return finish_image(image, md5, prehash, frim, size, locations, encodings, laps)
+
+def detect_faces(pictures, model="hog"):
+    """Face locations in each of a list of RGB arrays. The cnn model looks at pictures of the
+    same size together with batch_face_locations, which is much quicker on a GPU."""
+    import face_recognition
+    if model != "cnn":
+        return [face_recognition.face_locations(p, model=model) for p in pictures]
+    found = [None] * len(pictures)
+    by_shape = {}
+    for i, p in enumerate(pictures):
+        by_shape.setdefault(p.shape, []).append(i)
+    for indexes in by_shape.values():
+        batch = face_recognition.batch_face_locations([pictures[i] for i in indexes], batch_size=len(indexes))
+        for i, locations in zip(indexes, batch):
+            found[i] = locations
+    return found
+
+def face_chips(pixels, locations):
+    """The aligned 150x150 chips of the faces at locations, which is what dlib's encoder
+    actually looks at; face_recognition.face_encodings makes them the same way"""
+    import face_recognition, dlib
+    if not locations: return []
+    shapes = dlib.full_object_detections()
+    for location in locations:
+        shapes.append(face_recognition.api.pose_predictor_5_point(pixels, face_recognition.api._css_to_rect(location)))
+    return dlib.get_face_chips(pixels, shapes, size=150, padding=0.25)
+
+def encode_chips(chips, batch_size=128):
+    "Encodings of a list of face chips, passed to the encoder batch_size at a time"
+    import face_recognition
+    encodings = []
+    for start in range(0, len(chips), batch_size):
+        descriptors = face_recognition.api.face_encoder.compute_face_descriptor(chips[start:start + batch_size])
+        encodings.extend(np.array(d) for d in descriptors)
+    return encodings
+
+def load_batch(images, detect_pixels=None, encode_batch=128, model="hog"):
+    """Analyse several images as load_single does one, but encode the faces of all of them
+    together, encode_batch faces to a call, rather than paying dlib's per-call cost for every
+    face; with the cnn model, detection is batched too. Gives the same results as load_single.
+    Each image's thumbnail and crops are made as soon as its faces are found, and then only
+    its face chips are kept until the encoding, rather than its pixels; with cnn, every
+    image's pixels are needed until detection is done."""
+    chips = []
+    finished = []
+    def found(image, laps, md5, prehash, frim, size, detect, locations):
+        locations = scale_locations(locations, (detect.shape[1], detect.shape[0]), (frim.shape[1], frim.shape[0]))
+        chips.extend(face_chips(frim, locations))
+        laps("encode")
+        # the encodings are filled in once every image's chips have been encoded
+        finished.append((laps, finish_image(image, md5, prehash, frim, size, locations, [], laps)))
+    if model == "cnn":
+        decoded = []
+        for image in images:
+            laps = Laps()
+            decoded.append((image, laps) + read_and_decode(image[1], detect_pixels, laps))
+        start = time.perf_counter()
+        located = detect_faces([d[6] for d in decoded], model)
+        detect_seconds = (time.perf_counter() - start) / len(decoded)
+        for i, locations in enumerate(located):
+            d, decoded[i] = decoded[i], None
+            d[1].add("detect", detect_seconds)
+            found(*d, locations)
+            del d
+    else:
+        for image in images:
+            laps = Laps()
+            md5, prehash, frim, size, detect = read_and_decode(image[1], detect_pixels, laps)
+            locations = detect_faces([detect], model)[0]
+            laps("detect")
+            found(image, laps, md5, prehash, frim, size, detect, locations)
+            del frim, detect
+    start = time.perf_counter()
+    encodings = encode_chips(chips, encode_batch)
+    face_seconds = (time.perf_counter() - start) / len(chips) if chips else 0.0
+    results = []
+    for laps, result in finished:
+        mine, encodings = encodings[:len(result[1])], encodings[len(result[1]):]
+        laps.add("encode", face_seconds * len(mine))
+        results.append(result[:2] + (mine,) + result[3:])
+    return results
 
 def analyse_images_in_blocks():
     # Get the next N images that need processing, and process them
@@ -116,38 +786,376 @@ def analyse_images_in_blocks():
     c = db.cursor()
     pool = Pool() # don't use all processors, or the machine hangs
     chunk_size = 24 # higher is better, but we might run out of memory
-    c.execute("select count(*) from images where md5 is null")
+    c.execute("select count(*) from images where facecount is null")
     cnt = c.fetchone()[0]
     if cnt == 0: return (0, 0) # none left to process
-    c.execute("select id, full_path from images where md5 is null limit ?", (chunk_size,))
+    c.execute("select id, full_path from images where facecount is null limit ?", (chunk_size,))
     images = c.fetchall()
     results = pool.map(load_single, images) # map can take a chunksize, but we don't want all results in one huge object
     pool.close()
     pool.join()
+    store_analysis_results(c, results, get_crop_store())
+    db.commit()
+    return len(results), cnt - len(results)
 
+@timed
+def store_analysis_results(c, results, crop_store=None):
     image_updates = []
     face_inserts = []
-    for image_id, locations, encodings, md5, thumbnail, width, height in results:
+    crops = []
+    for image_id, locations, encodings, md5, thumbnail, width, height, face_crops, timings, prehash in results:
+        for stage, seconds in timings.items():
+            metrics.add_time("image." + stage, seconds)
         image_updates.append({"id": image_id, "md5": md5, 
             "thumbnail": thumbnail, "facecount": len(encodings), "width": width, "height": height})
         if encodings:
-            for loc, enc in zip(locations, encodings):
+            for index, (loc, enc) in enumerate(zip(locations, encodings)):
                 face_inserts.append({
                     "id": None,
                     "image": image_id,
-                    "encoding": base64.a85encode(enc.tostring()),
+                    "image_index": index,
+                    "encoding": encode_encoding(enc),
                     "x": loc[3],
                     "y": loc[0],
                     "w": loc[1] - loc[3],
                     "h": loc[2] - loc[0]
                 })
+        crops.extend((md5, index, crop) for index, crop in enumerate(face_crops))
+    metrics.count("images", len(results))
+    metrics.count("faces", len(face_inserts))
     c.executemany("""update images set md5=:md5, thumbnail=:thumbnail, facecount=:facecount,
                     width=:width, height=:height where id=:id""", image_updates)
     c.executemany("""INSERT OR IGNORE INTO faces 
-        (id, image, x, y, w, h, encoding)
-        VALUES (:id, :image, :x, :y, :w, :h, :encoding)""", face_inserts)
+        (id, image, image_index, x, y, w, h, encoding)
+        VALUES (:id, :image, :image_index, :x, :y, :w, :h, :encoding)""", face_inserts)
+    if crop_store is not None:
+        crop_store.put_many(crops)
+
+def init_worker():
+    "Runs once in each analysis worker, so the detector is warmed up before the first real image"
+    import face_recognition
+    face_recognition.face_locations(np.zeros((32, 32, 3), dtype=np.uint8))
+
+@timed
+def analyse_images(workers=None, in_flight=None, commit_every=24, detect_pixels=None,
+        batch=0, encode_batch=128, model="hog", use_cache=True):
+    """Analyse every image that needs it with one long-lived pool of workers. Images are fed
+    to the workers lazily, with at most in_flight queued or in progress at once so memory
+    stays bounded, results are taken in whatever order they finish, and they're written to
+    the database every commit_every images. detect_pixels is passed on to load_single.
+    With batch, each worker takes that many images at a time and encodes their faces
+    together with load_batch. With use_cache, photos already in the result cache aren't
+    decoded at all and copies of a photo are only analysed once, and new results are added
+    to the cache. Yields (processed, remaining) after each commit."""
+    db = get_db()
+    c = db.cursor()
+    c.execute("select id, full_path, size, md5, thumbnail from images where facecount is null")
+    images = c.fetchall()
+    if not images: return
+    crop_store = get_crop_store()
+    cache = get_result_cache(analysis_settings(detect_pixels, model if batch else "hog")) if use_cache else None
+    if cache: images = list(with_sizes(images))
+    analyse, cached, copies = split_duplicates(images, cache) if cache else (images, [], {})
+    metrics.count("images.cached", len(cached))
+    metrics.count("images.copies", len(images) - len(analyse) - len(cached))
+    processed = 0
+    for block in chunks(cached, commit_every):
+        results = []
+        for image, md5 in block:
+            width, height, locations, encodings, thumbnail, crops = cache.get(md5)
+            results.append((image[0], locations, encodings, md5, thumbnail, width, height, crops, {}, None))
+        with metrics.timer("sql.analysis"):
+            store_analysis_results(c, results, crop_store)
+            db.commit()
+        processed += len(results)
+        yield processed, len(images) - processed
+    if not analyse: return
+
+    by_id = dict((image[0], image) for image in analyse)
+    analyse = [(image[0], image[1], image[4]) for image in analyse]
+    if in_flight is None: in_flight = 4 * (workers or os.cpu_count())
+    if batch:
+        work = functools.partial(load_batch, detect_pixels=detect_pixels, encode_batch=encode_batch, model=model)
+        items = chunks(analyse, batch)
+        in_flight = max(1, in_flight // batch)
+    else:
+        work = functools.partial(load_single, detect_pixels=detect_pixels)
+        items = analyse
+    slots = threading.BoundedSemaphore(in_flight)
+    stopped = threading.Event()
+    def feed():
+        # runs in the pool's task-handler thread, which waits here while in_flight items are out;
+        # it gives up if we've stopped, say because a worker failed, so the pool can shut down
+        for item in items:
+            while not slots.acquire(timeout=1):
+                if stopped.is_set(): return
+            yield item
+    results = []
+    fresh = []
+    with Pool(workers, initializer=init_worker) as pool:
+        try:
+            for result in pool.imap_unordered(work, feed()):
+                slots.release()
+                for r in (result if batch else [result]):
+                    fresh.append(r)
+                    results.append(r)
+                    # copies share the md5, so they share the crops already stored for it too
+                    results.extend((copy[0],) + r[1:7] + ([], {}, r[9]) for copy in copies.get(r[0], []))
+                if len(results) >= commit_every or processed + len(results) == len(images):
+                    with metrics.timer("sql.analysis"):
+                        store_analysis_results(c, results, crop_store)
+                        db.commit()
+                    if cache:
+                        with metrics.timer("sql.cache"):
+                            cache.put_many((md5, by_id[image_id][2], prehash, width, height,
+                                locations, encodings, thumbnail, crops)
+                                for image_id, locations, encodings, md5, thumbnail, width, height, crops, timings, prehash in fresh)
+                    processed += len(results)
+                    results = []
+                    fresh = []
+                    yield processed, len(images) - processed
+        finally:
+            stopped.set()
+
+def get_shard_folder():
+    return get_sidecar_file(".shards")
+
+def plan_shards(count, folder=None):
+    """Split the images waiting to be analysed into count work manifests in folder, balanced by
+    bytes, so several machines sharing the photos' storage can analyse them with analyse_shard.
+    Returns the manifests' paths."""
+    folder = folder or get_shard_folder()
+    os.makedirs(folder, exist_ok=True)
+    c = get_db().cursor()
+    c.execute("select id, full_path, mtime, size, md5, thumbnail from images where facecount is null order by size desc")
+    shards = [[] for i in range(count)]
+    totals = [0] * count
+    for row in c.fetchall():
+        lightest = totals.index(min(totals))
+        shards[lightest].append(row)
+        totals[lightest] += row[3] or 0
+    paths = []
+    for number, images in enumerate(shards):
+        if not images: continue
+        path = os.path.join(folder, "shard-{:03d}.json".format(number))
+        with open(path + ".tmp", "w") as fp:
+            json.dump({"database": get_data_file(), "images": sorted(images)}, fp)
+        os.replace(path + ".tmp", path)
+        paths.append(path)
+    return paths
+
+def analyse_shard(manifest, **options):
+    """Analyse the images in a manifest from plan_shards into a database of their own next to
+    it, keeping the main database's image ids, md5s and thumbnails, with analyse_images and its
+    options. The main database's result cache is used. Nothing else in the process should be
+    using the database while this runs. Yields what analyse_images does."""
+    with open(manifest) as fp:
+        manifest_data = json.load(fp)
+    images = manifest_data["images"]
+    previous = dict((name, os.environ.get(name)) for name in ("PHOTO_FACE_DB", "PHOTO_FACE_CACHE"))
+    os.environ["PHOTO_FACE_CACHE"] = get_result_cache_file(manifest_data["database"])
+    os.environ["PHOTO_FACE_DB"] = os.path.splitext(manifest)[0] + ".db"
+    try:
+        init(overwrite=True)
+        db = get_db()
+        rows = []
+        for image_id, full_path, mtime, size, md5, thumbnail in images:
+            row = new_image_row(full_path, os.path.basename(full_path), mtime, size)
+            row.update(id=image_id, md5=md5, thumbnail=thumbnail)
+            rows.append(row)
+        insert_images(db.cursor(), rows)
+        db.commit()
+        for progress in analyse_images(**options):
+            yield progress
+    finally:
+        close_db()
+        for name, value in previous.items():
+            if value is None:
+                del os.environ[name]
+            else:
+                os.environ[name] = value
+
+@timed
+def merge_shard(shard):
+    """Fold the results in a shard database from analyse_shard into this database. Faces get new
+    ids here; images that have been analysed here since, or that have changed since the shard
+    was planned, are skipped, so merging a shard twice does nothing the second time.
+    Returns (images merged, faces merged, images skipped)."""
+    db = get_db()
+    c = db.cursor()
+    c.execute("attach database ? as shard", (shard,))
+    try:
+        c.execute("create temp table if not exists merging (id integer primary key)")
+        c.execute("delete from merging")
+        c.execute("""insert into merging select s.id from shard.images s inner join main.images m on m.id = s.id
+            where s.facecount is not null and m.facecount is null and m.full_path = s.full_path
+            and m.mtime is s.mtime and m.size is s.size""")
+        c.execute("select count(*) from shard.images where facecount is not null")
+        analysed = c.fetchone()[0]
+        c.execute("""update main.images set (md5, thumbnail, facecount, width, height) =
+            (select md5, coalesce(main.images.thumbnail, s.thumbnail), facecount, width, height
+            from shard.images s where s.id = main.images.id)
+            where id in (select id from merging)""")
+        merged = c.rowcount
+        c.execute("""insert into main.faces (image, image_index, x, y, w, h, encoding)
+            select image, image_index, x, y, w, h, encoding from shard.faces
+            where image in (select id from merging) order by id""")
+        faces = c.rowcount
+        c.execute("""select s.md5, s.facecount from shard.images s
+            where s.id in (select id from merging) and s.facecount > 0""")
+        with_faces = c.fetchall()
+        db.commit()
+    except:
+        db.rollback()
+        raise
+    finally:
+        c.execute("detach database shard")
+    shard_crops = cropstore.CropStore(os.path.splitext(shard)[0] + ".crop-packs")
+    crop_store = get_crop_store()
+    for block in chunks(with_faces, 100):
+        crops = [(md5, face, shard_crops.get(md5, face)) for md5, count in block for face in range(count)]
+        crop_store.put_many([crop for crop in crops if crop[2] is not None])
+    return merged, faces, analysed - merged
+
+ENCODING_BYTES = 128 * 8 # 128 float64s, as face_recognition makes them
+
+def encode_encoding(enc):
+    "Encodings are stored as raw float64 BLOBs"
+    return np.asarray(enc, dtype=np.float64).tobytes()
+
+def decode_encoding(encoding):
+    if len(encoding) != ENCODING_BYTES:
+        # databases from before migrate_encodings() hold base85 text
+        encoding = base64.a85decode(encoding)
+    return np.frombuffer(encoding, dtype=np.float64)
+
+@timed
+def migrate_encodings(chunk_size=10000):
+    "Rewrite base85 encodings from older databases as raw BLOBs; returns how many were converted"
+    db = get_db()
+    c = db.cursor()
+    converted = 0
+    while True:
+        c.execute("select id, encoding from faces where length(encoding) != ? limit ?", (ENCODING_BYTES, chunk_size))
+        rows = c.fetchall()
+        if not rows: break
+        c.executemany("update faces set encoding = ? where id = ?",
+            ((encode_encoding(decode_encoding(encoding)), face_id) for face_id, encoding in rows))
+        converted += len(rows)
+        db.commit()
+    return converted
+
+def get_faces_version(c):
+    c.execute("select value from meta where key = 'faces_version'")
+    return c.fetchone()[0]
+
+def get_groups_version(c):
+    c.execute("select value from meta where key = 'groups_version'")
+    return c.fetchone()[0]
+
+@timed
+def export_encodings():
+    """Write every encoding into a side-car .npy matrix (and a matching .npy of face ids)
+    next to the database, so they can be memory-mapped rather than read row by row"""
+    db = get_db()
+    c = db.cursor()
+    version = get_faces_version(c)
+    c.execute("select count(*) from faces")
+    count = c.fetchone()[0]
+    ids_file = get_sidecar_file(".encoding-ids.npy")
+    encodings_file = get_sidecar_file(".encodings.npy")
+    ids = np.lib.format.open_memmap(ids_file + ".tmp", mode="w+", dtype=np.int64, shape=(count,))
+    encodings = np.lib.format.open_memmap(encodings_file + ".tmp", mode="w+", dtype=np.float64, shape=(count, 128))
+    c.execute("select id, encoding from faces order by id")
+    row = 0
+    for face_id, encoding in c:
+        ids[row] = face_id
+        encodings[row] = decode_encoding(encoding)
+        row += 1
+    ids.flush()
+    encodings.flush()
+    del ids, encodings
+    os.replace(ids_file + ".tmp", ids_file)
+    os.replace(encodings_file + ".tmp", encodings_file)
+    c.execute("insert or replace into meta (key, value) values ('encodings_exported', ?)", (version,))
+    db.commit()
+
+@timed
+def load_all_encodings():
+    """Return an array of face ids and a matrix with the matching encodings as its rows. Both are
+    memory-mapped from the side-car files, which are rewritten first if faces has changed."""
+    c = get_db().cursor()
+    c.execute("select value from meta where key = 'encodings_exported'")
+    exported = c.fetchone()
+    if (not exported or exported[0] != get_faces_version(c)
+            or not os.path.exists(get_sidecar_file(".encodings.npy"))):
+        export_encodings()
+    return (np.load(get_sidecar_file(".encoding-ids.npy"), mmap_mode="r"),
+        np.load(get_sidecar_file(".encodings.npy"), mmap_mode="r"))
+
+def iter_close_pairs(ids, encodings, threshold, block_size=1024, rows=None):
+    """Yield (rows done, face1s, face2s, distances) for each block of rows, covering every pair
+    of faces no further apart than threshold. Squared distances are worked out a block
+    at a time as |a|^2 + |b|^2 - 2a.b, so memory stays at block_size^2 rather than n^2;
+    the pairs that pass are then measured exactly with np.linalg.norm, like the old path.
+    If rows (indexes into ids) is given, only pairs involving one of those faces are found,
+    so that new faces can be paired without pairing all the old ones again."""
+    encodings = np.ascontiguousarray(encodings, dtype=np.float64)
+    squares = np.einsum("ij,ij->i", encodings, encodings)
+    limit = threshold * threshold + 1e-9 # leeway for rounding in the identity
+    n = len(ids)
+    everything = rows is None
+    if everything: rows = np.arange(n)
+    is_row = np.zeros(n, dtype=bool)
+    is_row[rows] = True
+    for start in range(0, len(rows), block_size):
+        block = rows[start:start + block_size]
+        a = encodings[block]
+        firsts, seconds = [], []
+        # when pairing everything, columns before this block were done as rows already
+        for col in range(block[0] if everything else 0, n, block_size):
+            b = encodings[col:col + block_size]
+            d2 = squares[block, None] + squares[None, col:col + block_size] - 2 * (a @ b.T)
+            i, j = np.nonzero(d2 <= limit)
+            i = block[i]
+            j += col
+            once = (j > i) | ~is_row[j] # each pair once, and never a face with itself
+            firsts.append(i[once])
+            seconds.append(j[once])
+        i = np.concatenate(firsts)
+        j = np.concatenate(seconds)
+        distances = np.linalg.norm(encodings[i] - encodings[j], axis=1)
+        close = distances <= threshold
+        first, second = ids[i[close]], ids[j[close]]
+        yield start + len(block), np.minimum(first, second), np.maximum(first, second), distances[close]
+
+def store_pairs(c, face1s, face2s, distances):
+    c.executemany("""INSERT INTO pairs (face1, face2, distance, grouped) VALUES (?, ?, ?, 0)
+        ON CONFLICT (face1, face2) DO UPDATE SET distance=excluded.distance WHERE distance IS NULL""",
+        zip(face1s.tolist(), face2s.tolist(), distances.tolist()))
+
+@timed
+def pair_faces_vectorised(threshold=0.6, block_size=1024, new_only=False):
+    """Compare every face with every other in memory and store only the close pairs; with new_only,
+    just compare faces that haven't been paired yet with all the others.
+    Yields (faces done, total faces, pairs stored) after each block so callers can report progress."""
+    ids, encodings = load_all_encodings()
+    db = get_db()
+    c = db.cursor()
+    rows = None
+    if new_only:
+        c.execute("select id from faces where paired = 0")
+        rows = np.nonzero(np.isin(ids, [x[0] for x in c.fetchall()]))[0]
+    total = len(ids) if rows is None else len(rows)
+    stored = 0
+    for done, face1s, face2s, distances in iter_close_pairs(ids, encodings, threshold, block_size, rows):
+        with metrics.timer("sql.pairs"):
+            store_pairs(c, face1s, face2s, distances)
+            db.commit()
+        stored += len(face1s)
+        yield done, total, stored
+    c.execute("update faces set paired = 1 where paired = 0")
     db.commit()
-    return len(image_updates), cnt - len(image_updates)
 
 def insert_empty_pairs():
     db = get_db()
@@ -177,8 +1185,8 @@ def pair_faces_in_blocks():
         nxt = c.fetchone()
         if not nxt: break
         face1, face2, encoding_string1, encoding_string2 = nxt
-        encoding1 = np.fromstring(base64.a85decode(encoding_string1))
-        encoding2 = np.fromstring(base64.a85decode(encoding_string2))
+        encoding1 = decode_encoding(encoding_string1)
+        encoding2 = decode_encoding(encoding_string2)
         distance = np.linalg.norm(encoding1 - encoding2)
         pairs_updates.append({"face1": face1, "face2": face2, "distance": distance})
     c.executemany("UPDATE pairs SET distance=:distance WHERE face1=:face1 AND face2=:face2", pairs_updates)
@@ -199,6 +1207,7 @@ def random_name(length=7):
     word.append(random.choice(end_consonants))
     return "".join(word)
 
+@timed
 def group_faces_in_blocks(distance=0.5):
     db = get_db()
     c = db.cursor()
@@ -243,6 +1252,281 @@ def group_faces_in_blocks(distance=0.5):
         db.commit()
     return len(pairs), cnt
 
+class UnionFind:
+    "Disjoint sets, with path compression and union by rank"
+    def __init__(self):
+        self.parent = {}
+        self.rank = {}
+
+    def find(self, item):
+        parent = self.parent
+        if item not in parent:
+            parent[item] = item
+            self.rank[item] = 0
+            return item
+        root = item
+        while parent[root] != root:
+            root = parent[root]
+        while parent[item] != root:
+            parent[item], item = root, parent[item]
+        return root
+
+    def union(self, a, b):
+        a = self.find(a)
+        b = self.find(b)
+        if a == b: return a
+        if self.rank[a] < self.rank[b]: a, b = b, a
+        self.parent[b] = a
+        if self.rank[a] == self.rank[b]: self.rank[a] += 1
+        return a
+
+    def sets(self):
+        out = {}
+        for item in self.parent:
+            out.setdefault(self.find(item), []).append(item)
+        return out.values()
+
+@timed
+def group_faces_union_find(distance=0.5):
+    """Group faces in one pass rather than in blocks: existing groups and every ungrouped close
+    pair go into a union-find, and groups and faces2groups are rewritten in one transaction.
+    This gives the same partition as group_faces_in_blocks. When groups merge, a named group
+    keeps its id and name in preference to an unnamed one."""
+    db = get_db()
+    c = db.cursor()
+    sets = UnionFind()
+    current = {}
+    first_face = {}
+    c.execute("select face, groupid from faces2groups")
+    for face, groupid in c.fetchall():
+        current[face] = groupid
+        if groupid in first_face:
+            sets.union(face, first_face[groupid])
+        else:
+            first_face[groupid] = face
+            sets.find(face)
+    c.execute("select face1, face2 from pairs where distance <= ? and grouped=0", (distance,))
+    paired = 0
+    for face1, face2 in c.fetchall():
+        sets.union(face1, face2)
+        paired += 1
+    if paired == 0: return (0, len(first_face))
+
+    c.execute("select id, name from groups")
+    names = dict(c.fetchall())
+    assignments = []
+    new_sets = []
+    removed = set()
+    for members in sets.sets():
+        groupids = sorted(set(current[f] for f in members if f in current), key=lambda g: (names.get(g) is None, g))
+        if groupids:
+            removed.update(groupids[1:])
+            assignments.extend((face, groupids[0]) for face in members)
+        else:
+            new_sets.append(members)
+    for members in new_sets:
+        c.execute("insert into groups (name) values (null)")
+        assignments.extend((face, c.lastrowid) for face in members)
+    c.executemany("delete from groups where id = ?", ((g,) for g in removed))
+    c.execute("delete from faces2groups")
+    c.executemany("insert into faces2groups (face, groupid) values (?,?)", assignments)
+    c.execute("update pairs set grouped=1 where distance <= ? and grouped=0", (distance,))
+    db.commit()
+    return paired, len(first_face) - len(removed) + len(new_sets)
+
+def get_merge_tree_file():
+    return get_sidecar_file(".merge-tree.npz")
+
+def get_pairs_signature(c):
+    "Changes whenever close pairs are added, removed or re-measured, so the merge tree knows it's stale"
+    c.execute("""select (select value from meta where key = 'pairs_version'),
+        (select coalesce(max(rowid), 0) from pairs)""")
+    return list(c.fetchone())
+
+@timed
+def build_merge_tree(c):
+    """The minimum spanning forest of the close pairs, found with Kruskal's algorithm: going
+    through the pairs from closest to furthest, the ones that join two sets of faces for the
+    first time. Grouping at a distance is then just joining up the edges no longer than it,
+    which gives the same groups as grouping every pair would. Returns (face ids, edges as
+    pairs of positions in face ids, edge distances), with the edges sorted by distance."""
+    sets = UnionFind()
+    edges = []
+    c.execute("select face1, face2, distance from pairs where distance is not null order by distance")
+    for face1, face2, distance in c:
+        if sets.find(face1) != sets.find(face2):
+            sets.union(face1, face2)
+            edges.append((face1, face2, distance))
+    edges = np.array(edges, dtype=np.float64).reshape(-1, 3)
+    faces, positions = np.unique(edges[:, :2].astype(np.int64), return_inverse=True)
+    return faces, positions.reshape(-1, 2), edges[:, 2]
+
+MERGE_TREE_KEYS = ("merge_tree_pairs_version", "merge_tree_pairs_rowid")
+
+def load_merge_tree():
+    """The merge tree saved alongside the database, rebuilt first if the pairs have changed.
+    The pairs signature it was built from is kept in the database, like encodings_exported,
+    since a new database starts counting from 0 again and could reach the same signature."""
+    db = get_db()
+    c = db.cursor()
+    signature = get_pairs_signature(c)
+    built = [c.execute("select value from meta where key = ?", (key,)).fetchone() for key in MERGE_TREE_KEYS]
+    path = get_merge_tree_file()
+    if [row and row[0] for row in built] == signature and os.path.exists(path):
+        with np.load(path) as data:
+            return data["faces"], data["edges"], data["distances"]
+    faces, edges, distances = build_merge_tree(c)
+    np.savez(path, faces=faces, edges=edges, distances=distances)
+    c.executemany("insert or replace into meta (key, value) values (?, ?)", zip(MERGE_TREE_KEYS, signature))
+    db.commit()
+    return faces, edges, distances
+
+def forest_components(count, edges):
+    """Label each of count nodes with the smallest node joined to it by edges, by hooking each
+    edge's roots together and then pointer jumping, a round at a time, all in numpy"""
+    parent = np.arange(count)
+    a, b = edges[:, 0], edges[:, 1]
+    while len(a):
+        roots_a, roots_b = parent[a], parent[b]
+        lowest = np.minimum(roots_a, roots_b)
+        np.minimum.at(parent, roots_a, lowest)
+        np.minimum.at(parent, roots_b, lowest)
+        while True:
+            jumped = parent[parent]
+            if np.array_equal(jumped, parent): break
+            parent = jumped
+        unfinished = parent[a] != parent[b]
+        a, b = a[unfinished], b[unfinished]
+    return parent
+
+@timed
+def group_faces_by_cut(distance=0.5):
+    """Group faces by cutting the merge tree at distance, so trying a different distance doesn't
+    mean starting again. Each existing group's id and name go to whichever new group has most
+    of its faces, so groups that haven't changed keep their names, and if a group is split its
+    name goes to the biggest part. Only faces whose group has changed are written.
+    Returns (faces grouped, groups)."""
+    faces, edges, distances = load_merge_tree()
+    edges = edges[:np.searchsorted(distances, distance, side="right")]
+    grouped = np.zeros(len(faces), dtype=bool)
+    grouped[edges.ravel()] = True
+    labels = forest_components(len(faces), edges)[grouped]
+    faces = faces[grouped]
+
+    db = get_db()
+    c = db.cursor()
+    c.execute("select face, groupid from faces2groups order by face")
+    current = np.array(c.fetchall(), dtype=np.int64).reshape(-1, 2)
+    c.execute("select id, name, best_face from groups")
+    rows = c.fetchall()
+    names = dict((groupid, name) for groupid, name, best_face in rows)
+    # faces are sorted, so each face's current group (or -1) can be found with searchsorted
+    where = np.minimum(np.searchsorted(current[:, 0], faces), max(len(current) - 1, 0))
+    was = np.where(current[where, 0] == faces, current[where, 1], -1) if len(current) else np.full(len(faces), -1)
+    # each existing group goes to the new group holding most of its faces; a new group that's
+    # the best home of several keeps a named one if it can, and otherwise the one it has most of
+    overlaps, counts = np.unique(np.stack([labels, was], axis=1)[was >= 0], axis=0, return_counts=True)
+    best = {}
+    for (label, groupid), overlap in zip(overlaps.tolist(), counts.tolist()):
+        if groupid not in best or overlap > best[groupid][0]:
+            best[groupid] = (overlap, label)
+    # a named group left with no faces by an earlier, closer cut is found again by its best face
+    for groupid, name, best_face in rows:
+        if name is not None and groupid not in best and best_face is not None:
+            position = np.searchsorted(faces, best_face)
+            if position < len(faces) and faces[position] == best_face:
+                best[groupid] = (0, int(labels[position]))
+    claims = {}
+    for groupid, (overlap, label) in best.items():
+        claims.setdefault(label, []).append((names.get(groupid) is None, -overlap, groupid))
+    label_groups = {}
+    for label in np.unique(labels).tolist():
+        if label in claims:
+            label_groups[label] = min(claims[label])[2]
+        else:
+            c.execute("insert into groups (name) values (null)")
+            label_groups[label] = c.lastrowid
+    kept = set(label_groups.values())
+    # named groups that have lost all their faces are kept, empty, so they get them back later
+    for groupid, name in names.items():
+        if groupid not in kept and name is not None:
+            logging.warning("Group %s (%s) has no faces at distance %s", groupid, name, distance)
+    c.executemany("delete from groups where id = ?", ((g,) for g in names if g not in kept and names[g] is None))
+
+    now = np.array([label_groups[label] for label in labels.tolist()], dtype=np.int64)
+    moved = (was >= 0) & (was != now)
+    added = was < 0
+    c.executemany("delete from faces2groups where face = ?",
+        ((f,) for f in np.setdiff1d(current[:, 0], faces).tolist()))
+    c.executemany("update faces2groups set groupid = ? where face = ?", zip(now[moved].tolist(), faces[moved].tolist()))
+    c.executemany("insert into faces2groups (face, groupid) values (?,?)", zip(faces[added].tolist(), now[added].tolist()))
+
+    # grouped only matters to the one-pair-at-a-time ways of grouping, which skip pairs already
+    # used; ones further apart than distance might not be reflected in the groups any more
+    c.execute("update pairs set grouped = 0 where distance > ? and grouped = 1", (distance,))
+    db.commit()
+    return len(faces), len(label_groups)
+
+def assign_face_to_group(c, face, distance=0.5):
+    """Fold one face into the groups, using its close pairs that haven't been grouped yet,
+    and touching only the groups involved. If the face matches faces in several groups
+    they are merged, keeping a named group's id and name in preference to an unnamed one.
+    Returns the face's group id, or None if it matched nothing."""
+    c.execute("""select face1, face2 from pairs where (face1 = ? or face2 = ?)
+        and distance <= ? and grouped = 0""", (face, face, distance))
+    pairs = c.fetchall()
+    if not pairs: return None
+    faces = set(itertools.chain.from_iterable(pairs))
+    qmarks = ",".join(["?"] * len(faces))
+    c.execute("select face, groupid from faces2groups where face in ({})".format(qmarks), list(faces))
+    current = dict(c.fetchall())
+    groupids = list(set(current.values()))
+    if groupids:
+        qmarks = ",".join(["?"] * len(groupids))
+        c.execute("select id, name from groups where id in ({})".format(qmarks), groupids)
+        names = dict(c.fetchall())
+        groupids.sort(key=lambda g: (names[g] is None, g))
+        groupid = groupids[0]
+        for other in groupids[1:]:
+            if names[other] is not None:
+                logging.warning("Merging group %s (%s) into group %s (%s)", other, names[other], groupid, names[groupid])
+            c.execute("update faces2groups set groupid = ? where groupid = ?", (groupid, other))
+            c.execute("delete from groups where id = ?", (other,))
+    else:
+        c.execute("insert into groups (name) values (null)")
+        groupid = c.lastrowid
+    c.executemany("insert into faces2groups (face, groupid) values (?,?)",
+        [(f, groupid) for f in faces if f not in current])
+    c.executemany("update pairs set grouped=1 where face1=? and face2=?", pairs)
+    return groupid
+
+@timed
+def assign_new_faces(distance=0.5, threshold=0.6):
+    """Pair and group faces that haven't been paired yet one at a time, as they arrive, rather
+    than re-running pairing and grouping for everything. Each face is compared with all the
+    others in memory, its close pairs are stored, and it's folded into the groups.
+    Yields (face id, group id or None, seconds taken) for each face."""
+    ids, encodings = load_all_encodings()
+    squares = np.einsum("ij,ij->i", encodings, encodings)
+    limit = threshold * threshold + 1e-9
+    db = get_db()
+    c = db.cursor()
+    c.execute("select id from faces where paired = 0 order by id")
+    new = [x[0] for x in c.fetchall()]
+    for face, position in zip(new, np.searchsorted(ids, new)):
+        start = time.time()
+        encoding = encodings[position]
+        close = np.nonzero(squares + squares[position] - 2 * (encodings @ encoding) <= limit)[0]
+        close = close[close != position]
+        distances = np.linalg.norm(encodings[close] - encoding, axis=1)
+        others = ids[close[distances <= threshold]]
+        store_pairs(c, np.minimum(others, face), np.maximum(others, face), distances[distances <= threshold])
+        c.execute("update faces set paired = 1 where id = ?", (face,))
+        groupid = assign_face_to_group(c, face, distance)
+        db.commit()
+        yield face, groupid, time.time() - start
+
+@timed
 def find_best_faces():
     db = get_db()
     c = db.cursor()
@@ -260,40 +1544,32 @@ def dict_factory(cursor, row):
         d[col[0]] = row[idx]
     return d
 
-def get_groups_and_faces():
+def get_groups_and_faces(offset=0, limit=-1):
     db = get_db()
     c = db.cursor()
-    sql = """select g.id, g.name, f.x, f.y, f.w, f.h, i.full_path
+    sql = """select g.id, g.name, f.x, f.y, f.w, f.h, i.full_path, i.md5, f.image_index
         from groups g inner join faces f on g.best_face = f.id
-        inner join images i on f.image = i.id"""
-    c.execute(sql)
-    out = [dict(zip(["groupid", "groupname", "x", "y", "w", "h", "image"], r)) for r in c.fetchall()]
+        inner join images i on f.image = i.id
+        order by g.id limit ? offset ?"""
+    c.execute(sql, (limit, offset))
+    out = [dict(zip(["groupid", "groupname", "x", "y", "w", "h", "image", "md5", "image_index"], r))
+        for r in c.fetchall()]
     return out
 
+def count_groups_and_faces():
+    "How many rows get_groups_and_faces() would return"
+    c = get_db().cursor()
+    c.execute("""select count(*) from groups g inner join faces f on g.best_face = f.id
+        inner join images i on f.image = i.id""")
+    return c.fetchone()[0]
+
 def update_groupname(groupid, name):
     db = get_db()
     c = db.cursor()
     c.execute("update groups set name = ? where id = ?", (name, groupid))
     db.commit()
 
-def simple_gallery(output):
-    db = get_db()
-    c = db.cursor()
-    c.execute("""select g.id, g.name, i.thumbnail, i.filename, i.full_path, f.x, f.y, f.w, f.h, i.width, i.height
-        from groups g inner join faces2groups f2g on g.id = f2g.groupid
-        inner join faces f on f2g.face = f.id
-        inner join images i on f.image = i.id
-        order by g.name, i.filename
-        """)
-    groups = {}
-    for groupid, groupname, thumbnail, filename, full_path, fx, fy, fw, fh, iw, ih in c.fetchall():
-        gn = groupname if groupname else "Group {}".format(groupid)
-        if gn not in groups: groups[gn] = []
-        groups[gn].append((thumbnail, filename, full_path, fx, fy, fw, fh, iw, ih))
-    with open(output, encoding="utf-8", mode="w") as fp:
-        fp.write("""<!doctype html>
-            <html><head><meta charset="utf-8"><title>Autogrouped gallery</title>
-            <style>
+GALLERY_STYLE = """
             body { font-family: sans-serif; color: white; background: #444444; padding-top: 50px; }
             figure { float: left; margin: 4px; position: relative; overflow: hidden; }
             img { max-height: 150px; box-shadow: 2px 2px 2px rgba(0,0,0,0.6); }
@@ -319,26 +1595,14 @@ def simple_gallery(output):
                 max-width: 100%;
                 max-height: 100%;
             }
-            </style>
-            </head><body><p><label><input type="checkbox"> Show faces</label></p>
-            """)
-        for groupname in groups:
-            fp.write("\n<h1>{}</h1><div>".format(groupname))
-            for thumbnail, filename, full_path, fx, fy, fw, fh, iw, ih in sorted(groups[groupname], key=lambda x:x[1]):
-                fxpc = 100 * float(fx) / iw
-                fypc = 100 * float(fy) / ih
-                fwpc = 100 * float(fw) / iw
-                fhpc = 100 * float(fh) / ih
-                fp.write("""<figure>
-                    <img src="{}" data-face="{},{},{},{}" data-full="{}">
-                    </figure>""".format(thumbnail, fxpc, fypc, fwpc, fhpc, full_path))
-            fp.write("</div>")
-        fp.write("""<script>
+            """
+
+GALLERY_SCRIPT = """
             var madeFaces = false;
             document.querySelector("input").onchange = function() {
                 if (this.checked) {
                     if (!madeFaces) {
-                        Array.from(document.querySelectorAll("img")).forEach(function(img) {
+                        Array.from(document.querySelectorAll("img.thumbnail")).forEach(function(img) {
                             fpc = img.dataset.face.split(",").map(v => { return parseFloat(v); })
                             var span = document.createElement("span");
                             var fig = img.parentNode;
@@ -366,6 +1630,11 @@ def simple_gallery(output):
                     bfi.onload = function() {
                         fpc = bfi.dataset.face.split(",").map(v => { return parseFloat(v); })
                         var span = bigfig.querySelector("span");
+                        if (!span) {
+                            // crops and unticked thumbnails have no outline yet
+                            span = document.createElement("span");
+                            bigfig.appendChild(span);
+                        }
                         var fw = parseInt(window.getComputedStyle(bigfig, null).width); // offset* includes the border
                         var fh = parseInt(window.getComputedStyle(bigfig, null).height);
                         var scalex = bfi.offsetWidth / fw;
@@ -382,5 +1651,143 @@ def simple_gallery(output):
                     }
                 }
             }
-            </script>""")
+            """
+
+def gallery_image(folder, faces, crop_store, thumbnail, md5, image_index):
+    """The src and class for a gallery image: the face's crop if there is one, copied into the
+    faces folder under folder and given relative to folder, or else the thumbnail. Crops are
+    files rather than inline so the page stays small. A crop is copied again even if it's
+    there already, since analysing again may have replaced it."""
+    if md5 and image_index is not None:
+        crop_file = "{}/{}-{}.jpg".format(faces, md5, image_index)
+        crop = crop_store.get(md5, image_index)
+        if crop:
+            with open(os.path.join(folder, crop_file), "wb") as f: f.write(crop)
+            return crop_file, "crop"
+    return thumbnail, "thumbnail"
+
+def gallery_figure(src, cls, full_path, fx, fy, fw, fh, iw, ih):
+    fxpc = 100 * float(fx) / iw
+    fypc = 100 * float(fy) / ih
+    fwpc = 100 * float(fw) / iw
+    fhpc = 100 * float(fh) / ih
+    return """<figure>
+        <img src="{}" class="{}" loading="lazy" data-face="{},{},{},{}" data-full="{}">
+        </figure>""".format(html.escape(src), cls, fxpc, fypc, fwpc, fhpc, html.escape(full_path))
+
+@timed
+def simple_gallery(output):
+    "Write the whole gallery to one page, with the face crops in a folder beside it"
+    folder = os.path.dirname(os.path.abspath(output))
+    faces = os.path.splitext(os.path.basename(output))[0] + "-faces"
+    os.makedirs(os.path.join(folder, faces), exist_ok=True)
+    db = get_db()
+    c = db.cursor()
+    crop_store = get_crop_store()
+    c.execute("""select g.id, g.name, i.thumbnail, i.filename, i.full_path, f.x, f.y, f.w, f.h, i.width, i.height,
+        i.md5, f.image_index
+        from groups g inner join faces2groups f2g on g.id = f2g.groupid
+        inner join faces f on f2g.face = f.id
+        inner join images i on f.image = i.id
+        order by g.name, i.filename
+        """)
+    groups = {}
+    for groupid, groupname, thumbnail, filename, full_path, fx, fy, fw, fh, iw, ih, md5, image_index in c.fetchall():
+        gn = groupname if groupname else "Group {}".format(groupid)
+        if gn not in groups: groups[gn] = []
+        groups[gn].append((gallery_image(folder, faces, crop_store, thumbnail, md5, image_index), filename, full_path, fx, fy, fw, fh, iw, ih))
+    with open(output, encoding="utf-8", mode="w") as fp:
+        fp.write("""<!doctype html>
+            <html><head><meta charset="utf-8"><title>Autogrouped gallery</title>
+            <style>{}</style>
+            </head><body><p><label><input type="checkbox"> Show faces</label></p>
+            """.format(GALLERY_STYLE))
+        for groupname in groups:
+            fp.write("\n<h1>{}</h1><div>".format(html.escape(groupname)))
+            for (src, cls), filename, full_path, fx, fy, fw, fh, iw, ih in sorted(groups[groupname], key=lambda x:x[1]):
+                fp.write(gallery_figure(src, cls, full_path, fx, fy, fw, fh, iw, ih))
+            fp.write("</div>")
+        fp.write("<script>{}</script>".format(GALLERY_SCRIPT))
         fp.write("</body></html>")
+
+GALLERY_PAGE = """<!doctype html>
+<html><head><meta charset="utf-8"><title>{title}</title>
+<link rel="stylesheet" href="gallery.css">
+</head><body><p>{nav}</p>
+<h1>{title}</h1><div>
+"""
+
+@timed
+def paged_gallery(output, page_size=200):
+    """Write the gallery as a folder: index.html listing the groups, and a page for each group,
+    split into several pages if it has more than page_size faces. Rows are streamed from the
+    database a group at a time rather than all loaded at once, and a group's pages are only
+    rewritten if the group has changed since the last run. Face crops are copied into the
+    folder so that the browser can load them lazily. Returns (groups written, groups unchanged)."""
+    os.makedirs(os.path.join(output, "faces"), exist_ok=True)
+    manifest_file = os.path.join(output, "gallery.json")
+    try:
+        with open(manifest_file, encoding="utf-8") as fp:
+            manifest = json.load(fp)
+    except FileNotFoundError:
+        manifest = {}
+    with open(os.path.join(output, "gallery.css"), encoding="utf-8", mode="w") as fp:
+        fp.write(GALLERY_STYLE + "p a { color: white; margin-left: 1em; } li a { color: white; }")
+    with open(os.path.join(output, "gallery.js"), encoding="utf-8", mode="w") as fp:
+        fp.write(GALLERY_SCRIPT)
+
+    crop_store = get_crop_store()
+    c = get_db().cursor()
+    c.execute("""select g.id, g.name, i.thumbnail, i.filename, i.full_path, f.x, f.y, f.w, f.h, i.width, i.height,
+        i.md5, f.image_index
+        from groups g inner join faces2groups f2g on g.id = f2g.groupid
+        inner join faces f on f2g.face = f.id
+        inner join images i on f.image = i.id
+        order by g.name is null, g.name, g.id, i.filename, f.id
+        """)
+    seen = {}
+    written = unchanged = 0
+    with open(os.path.join(output, "index.html.tmp"), encoding="utf-8", mode="w") as index:
+        index.write(GALLERY_PAGE.format(title="Autogrouped gallery", nav=""))
+        index.write("</div><ul>")
+        for groupid, rows in itertools.groupby(c, key=lambda row: row[0]):
+            rows = list(rows)
+            title = html.escape(rows[0][1] or "Group {}".format(groupid))
+            # the page size decides how the rows are split, so a different one means new pages
+            signature = hashlib.md5(repr((page_size, rows)).encode("utf-8")).hexdigest()
+            seen[str(groupid)] = signature
+            pages = (len(rows) + page_size - 1) // page_size
+            names = ["group-{}.html".format(groupid)] + ["group-{}-{}.html".format(groupid, n) for n in range(2, pages + 1)]
+            if manifest.get(str(groupid)) == signature and all(os.path.exists(os.path.join(output, n)) for n in names):
+                unchanged += 1
+            else:
+                remove_gallery_pages(output, groupid)
+                for number, page_rows in enumerate(chunks(rows, page_size)):
+                    write_gallery_page(output, names, number, title, page_rows, crop_store)
+                written += 1
+            index.write('<li><a href="{}">{}</a> ({} faces)</li>\n'.format(names[0], title, len(rows)))
+        index.write("</ul></body></html>")
+    os.replace(os.path.join(output, "index.html.tmp"), os.path.join(output, "index.html"))
+    for groupid in set(manifest) - set(seen):
+        remove_gallery_pages(output, groupid)
+    with open(manifest_file, encoding="utf-8", mode="w") as fp:
+        json.dump(seen, fp)
+    return written, unchanged
+
+def remove_gallery_pages(output, groupid):
+    prefix = "group-{}".format(groupid)
+    for name in os.listdir(output):
+        if name == prefix + ".html" or (name.startswith(prefix + "-") and name.endswith(".html")):
+            os.unlink(os.path.join(output, name))
+
+def write_gallery_page(output, names, number, title, rows, crop_store):
+    nav = ['<label><input type="checkbox"> Show faces</label>', '<a href="index.html">All groups</a>']
+    if number > 0: nav.append('<a href="{}">Previous</a>'.format(names[number - 1]))
+    if number < len(names) - 1: nav.append('<a href="{}">Next</a>'.format(names[number + 1]))
+    if len(names) > 1: title = "{} ({}/{})".format(title, number + 1, len(names))
+    with open(os.path.join(output, names[number]), encoding="utf-8", mode="w") as fp:
+        fp.write(GALLERY_PAGE.format(title=title, nav=" ".join(nav)))
+        for groupid, groupname, thumbnail, filename, full_path, fx, fy, fw, fh, iw, ih, md5, image_index in rows:
+            src, cls = gallery_image(output, "faces", crop_store, thumbnail, md5, image_index)
+            fp.write(gallery_figure(src, cls, full_path, fx, fy, fw, fh, iw, ih))
+        fp.write('</div><script src="gallery.js"></script></body></html>')
@@ -0,0 +1,61 @@
+"Face crops made during analysis, packed into a few large files"
+import os
+import sqlite3
+import threading
+
+class CropStore:
+    """Small JPEG crops of faces, keyed by the md5 of the photo and the face's position in
+    it, so the same photo in two places shares its crops. Crops are appended to pack files
+    of up to pack_bytes each, rather than being millions of little files, and an sqlite
+    index in the same folder records where each one is. Analysing a photo again with other
+    settings can find other faces, so a different crop replaces the stored one; the old
+    bytes are left in their pack. Only one process should write."""
+    def __init__(self, folder, pack_bytes=256 * 1024 * 1024):
+        self.folder = folder
+        self.pack_bytes = pack_bytes
+        os.makedirs(folder, exist_ok=True)
+        # readers may be on other threads, like the labelling UI's prefetcher
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(folder, "index.db"), check_same_thread=False)
+        self.db.execute("""create table if not exists crops (md5 text, face int,
+            pack int, offset int, length int, primary key (md5, face))""")
+        self.db.commit()
+
+    def pack_path(self, pack):
+        return os.path.join(self.folder, "pack-{:05d}.bin".format(pack))
+
+    def put_many(self, crops):
+        "Store (md5, face index, jpeg bytes) crops; ones already stored just as they are are left alone"
+        crops = dict(((md5, face), data) for md5, face, data in crops if self.get(md5, face) != data)
+        if not crops: return
+        with self.lock:
+            pack = self.db.execute("select max(pack) from crops").fetchone()[0] or 0
+        rows = []
+        f = open(self.pack_path(pack), "ab")
+        try:
+            for (md5, face), data in crops.items():
+                if f.tell() and f.tell() + len(data) > self.pack_bytes:
+                    f.close()
+                    pack += 1
+                    f = open(self.pack_path(pack), "ab")
+                rows.append((md5, face, pack, f.tell(), len(data)))
+                f.write(data)
+        finally:
+            f.close()
+        with self.lock:
+            self.db.executemany("insert or replace into crops (md5, face, pack, offset, length) values (?,?,?,?,?)", rows)
+            self.db.commit()
+
+    def has(self, md5, face):
+        with self.lock:
+            return self.db.execute("select 1 from crops where md5 = ? and face = ?", (md5, face)).fetchone() is not None
+
+    def get(self, md5, face):
+        "The jpeg bytes of a crop, or None if there isn't one"
+        with self.lock:
+            row = self.db.execute("select pack, offset, length from crops where md5 = ? and face = ?", (md5, face)).fetchone()
+        if not row: return None
+        pack, offset, length = row
+        with open(self.pack_path(pack), "rb") as f:
+            f.seek(offset)
+            return f.read(length)
@@ -0,0 +1,137 @@
+"Face crops for the labelling UI, cached on disk and fetched ahead of time"
+import io
+import os
+import queue
+import hashlib
+import logging
+import tempfile
+import threading
+import collections
+from PIL import Image
+import core
+
+class FaceCropCache:
+    """Face crops, scaled to fit in a size x size box and saved as JPEGs in a cache folder,
+    so that showing a face doesn't mean decoding its whole photo. The least recently used
+    crops are deleted once the folder holds more than max_bytes. Crops made during analysis
+    are taken from the crop store; the original photo is only opened if there isn't one."""
+    def __init__(self, folder=None, size=400, max_bytes=256 * 1024 * 1024, store=None):
+        self.folder = folder or core.get_sidecar_file(".crops")
+        self.store = store or core.get_crop_store()
+        self.size = size
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(self.folder, exist_ok=True)
+        # path -> bytes, least recently used first
+        self.entries = collections.OrderedDict()
+        existing = [os.path.join(self.folder, f) for f in os.listdir(self.folder) if f.endswith(".jpg")]
+        for path in sorted(existing, key=os.path.getmtime):
+            self.entries[path] = os.path.getsize(path)
+        self.total = sum(self.entries.values())
+
+    def path_for(self, face):
+        key = "{image}:{x},{y},{w},{h}:{size}".format(size=self.size, **face)
+        return os.path.join(self.folder, hashlib.md5(key.encode("utf-8")).hexdigest() + ".jpg")
+
+    def get(self, face):
+        """The path to a crop of face (a row from core.get_groups_and_faces), making it if needed"""
+        path = self.path_for(face)
+        with self.lock:
+            if path in self.entries:
+                self.entries.move_to_end(path)
+                os.utime(path) # so the order survives a restart
+                return path
+        self.make(face, path)
+        with self.lock:
+            if path not in self.entries:
+                self.entries[path] = os.path.getsize(path)
+                self.total += self.entries[path]
+            self.evict()
+        return path
+
+    def make(self, face, path):
+        stored = None
+        if face.get("md5") and face.get("image_index") is not None:
+            stored = self.store.get(face["md5"], face["image_index"])
+        if stored:
+            crop = Image.open(io.BytesIO(stored))
+        else:
+            crop = self.crop_original(face)
+        # scale so the longer side fills the box, up or down, as the UI always did
+        ratio = float(self.size) / max(crop.size)
+        # the prefetcher and the UI can both be making the same crop, so each writes its own temp file
+        fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=self.folder)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                if stored and ratio == 1:
+                    f.write(stored)
+                else:
+                    crop = crop.resize((max(1, int(crop.size[0] * ratio)), max(1, int(crop.size[1] * ratio))), Image.BILINEAR)
+                    crop.save(f, "JPEG", quality=90)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def crop_original(self, face):
+        im = Image.open(face["image"])
+        width, height = im.size
+        # JPEGs can be decoded at a fraction of their size, as long as the face stays big enough
+        scale = min(1.0, max(float(self.size) / face["w"], float(self.size) / face["h"]))
+        im.draft("RGB", (int(width * scale), int(height * scale)))
+        sx = float(im.size[0]) / width
+        sy = float(im.size[1]) / height
+        return im.convert("RGB").crop((int(face["x"] * sx), int(face["y"] * sy),
+            int((face["x"] + face["w"]) * sx), int((face["y"] + face["h"]) * sy)))
+
+    def evict(self):
+        while self.total > self.max_bytes and len(self.entries) > 1:
+            path, size = self.entries.popitem(last=False)
+            self.total -= size
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+class Prefetcher:
+    """Makes crops on a background thread. Each call to prefetch() replaces whatever was still
+    waiting, so it always works on what's near the current position."""
+    def __init__(self, cache):
+        self.cache = cache
+        self.pending = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def prefetch(self, faces):
+        while True:
+            try:
+                self.pending.get_nowait()
+            except queue.Empty:
+                break
+        for face in faces:
+            self.pending.put(face)
+
+    def run(self):
+        while True:
+            face = self.pending.get()
+            try:
+                self.cache.get(face)
+            except Exception:
+                logging.exception("Couldn't make a face crop from %s", face["image"])
+
+class GroupPages:
+    "The rows of core.get_groups_and_faces(), fetched from the database a page at a time as they're used"
+    def __init__(self, page_size=100):
+        self.page_size = page_size
+        self.count = core.count_groups_and_faces()
+        self.pages = {}
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if index < 0 or index >= self.count: raise IndexError(index)
+        page = index // self.page_size
+        if page not in self.pages:
+            self.pages[page] = core.get_groups_and_faces(page * self.page_size, self.page_size)
+        return self.pages[page][index % self.page_size]
@@ -0,0 +1,293 @@
+"Approximate nearest-neighbour index over face encodings"
+import os
+import logging
+import numpy as np
+import core
+
+def squared_distances(a, b, b_squares=None):
+    "All squared distances between rows of a and rows of b, via |a|^2 + |b|^2 - 2a.b"
+    if b_squares is None: b_squares = np.einsum("ij,ij->i", b, b)
+    d2 = np.einsum("ij,ij->i", a, a)[:, None] + b_squares[None, :] - 2 * (a @ b.T)
+    return np.maximum(d2, 0)
+
+def nearest_centroids(data, centroids, block_size=4096):
+    squares = np.einsum("ij,ij->i", centroids, centroids)
+    labels = np.empty(len(data), dtype=np.int64)
+    for start in range(0, len(data), block_size):
+        block = data[start:start + block_size]
+        labels[start:start + block_size] = np.argmin(squares[None, :] - 2 * (block @ centroids.T), axis=1)
+    return labels
+
+def kmeans(data, k, iterations=10, seed=0):
+    rng = np.random.default_rng(seed)
+    centroids = data[rng.choice(len(data), k, replace=False)].copy()
+    for i in range(iterations):
+        labels = nearest_centroids(data, centroids)
+        counts = np.bincount(labels, minlength=k)
+        sums = np.zeros_like(centroids)
+        for dim in range(data.shape[1]):
+            sums[:, dim] = np.bincount(labels, weights=data[:, dim], minlength=k)
+        filled = counts > 0 # an empty cluster keeps its old centroid
+        centroids[filled] = sums[filled] / counts[filled, None]
+    return centroids
+
+class FaceIndex:
+    """An inverted-file index: encodings are bucketed by the nearest of a set of k-means
+    centroids, and queries only look in buckets whose centroid is near enough. Each bucket
+    knows its radius (its furthest member from the centroid), so by the triangle inequality
+    a radius query can skip buckets that can't hold a match and still be exact; passing
+    nprobe limits the search to that many nearest buckets, which is faster but approximate."""
+    def __init__(self, centroids, ids, encodings, labels, trained_size):
+        self.centroids = centroids
+        self.trained_size = trained_size
+        self._set_members(ids, encodings, labels)
+
+    def _set_members(self, ids, encodings, labels):
+        order = np.argsort(labels, kind="stable")
+        self.ids = ids[order]
+        self.encodings = np.ascontiguousarray(encodings[order])
+        self.labels = labels[order]
+        self.squares = np.einsum("ij,ij->i", self.encodings, self.encodings)
+        counts = np.bincount(self.labels, minlength=len(self.centroids))
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+        spread = np.linalg.norm(self.encodings - self.centroids[self.labels], axis=1)
+        self.radii = np.zeros(len(self.centroids))
+        np.maximum.at(self.radii, self.labels, spread)
+
+    @classmethod
+    def build(cls, ids, encodings, lists=None, iterations=10, sample=None):
+        "Train the centroids on (a sample of) the encodings and index them all"
+        if lists is None: lists = max(1, int(2 * np.sqrt(len(ids))))
+        lists = min(lists, len(ids))
+        if sample is None: sample = lists * 64
+        train = encodings
+        if len(encodings) > sample:
+            train = encodings[np.random.default_rng(0).choice(len(encodings), sample, replace=False)]
+        centroids = kmeans(train, lists, iterations)
+        return cls(centroids, ids, encodings, nearest_centroids(encodings, centroids), len(ids))
+
+    def add(self, ids, encodings):
+        "Put new encodings into their nearest existing bucket, without retraining"
+        labels = nearest_centroids(encodings, self.centroids)
+        self._set_members(np.concatenate([self.ids, ids]),
+            np.vstack([self.encodings, encodings]), np.concatenate([self.labels, labels]))
+
+    def remove(self, ids):
+        keep = ~np.isin(self.ids, ids)
+        self._set_members(self.ids[keep], self.encodings[keep], self.labels[keep])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _members(self, lists):
+        if len(lists) == 0: return np.zeros(0, dtype=np.int64)
+        return np.concatenate([np.arange(self.offsets[l], self.offsets[l + 1]) for l in lists])
+
+    def _centroid_distances(self, query):
+        return np.linalg.norm(self.centroids - query, axis=1)
+
+    def search(self, query, k=10, nprobe=8):
+        "The k nearest faces to query, as (ids, distances), looking in the nprobe nearest buckets"
+        lists = np.argsort(self._centroid_distances(query))[:nprobe]
+        members = self._members(lists)
+        distances = np.linalg.norm(self.encodings[members] - query, axis=1)
+        top = np.argsort(distances)[:k]
+        return self.ids[members[top]], distances[top]
+
+    def radius(self, query, radius, nprobe=None):
+        "All faces within radius of query, as (ids, distances); exact unless nprobe is given"
+        centroid_distances = self._centroid_distances(query)
+        lists = np.nonzero(centroid_distances - self.radii <= radius)[0]
+        lists = lists[np.argsort(centroid_distances[lists])][:nprobe]
+        members = self._members(lists)
+        distances = np.linalg.norm(self.encodings[members] - query, axis=1)
+        close = distances <= radius
+        return self.ids[members[close]], distances[close]
+
+    def close_pairs(self, radius, nprobe=None):
+        """Yield (buckets done, face1s, face2s, distances) for each bucket, covering all pairs
+        of faces within radius of one another. Exact unless nprobe is given, in which case
+        each bucket is only compared with its nprobe nearest buckets."""
+        between = np.sqrt(squared_distances(self.centroids, self.centroids))
+        if nprobe is None:
+            probes = between <= radius + self.radii[:, None] + self.radii[None, :]
+        else:
+            probes = np.zeros(between.shape, dtype=bool)
+            nearest = np.argsort(between, axis=1)[:, :nprobe]
+            probes[np.arange(len(between))[:, None], nearest] = True
+            probes[np.arange(len(between)), np.arange(len(between))] = True
+        limit = radius * radius + 1e-9
+        for a in range(len(self.centroids)):
+            if self.offsets[a] == self.offsets[a + 1]: continue
+            # each pair of buckets is done once, by the lower one if both would probe the other
+            others = np.nonzero(probes[a] & ((np.arange(len(probes)) >= a) | ~probes[:, a]))[0]
+            rows = np.arange(self.offsets[a], self.offsets[a + 1])
+            cols = self._members(others)
+            d2 = squared_distances(self.encodings[rows], self.encodings[cols], self.squares[cols])
+            i, j = np.nonzero(d2 <= limit)
+            i = rows[i]
+            j = cols[j]
+            keep = (self.labels[j] != a) | (j > i)
+            i, j = i[keep], j[keep]
+            distances = np.linalg.norm(self.encodings[i] - self.encodings[j], axis=1)
+            close = distances <= radius
+            first, second = self.ids[i[close]], self.ids[j[close]]
+            yield a + 1, np.minimum(first, second), np.maximum(first, second), distances[close]
+
+    def save(self, path):
+        np.savez(path, centroids=self.centroids, ids=self.ids, encodings=self.encodings,
+            labels=self.labels, trained_size=self.trained_size)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["centroids"], data["ids"], data["encodings"], data["labels"],
+                int(data["trained_size"]))
+
+def get_index_file():
+    return core.get_sidecar_file(".index.npz")
+
+def update_index(rebuild=False, lists=None):
+    """Bring the index alongside faces.db up to date with the faces table: new faces are
+    added to the existing buckets, and once the library has doubled since the centroids
+    were trained (or if asked) it is rebuilt from scratch. Faces are matched up by id, but
+    sqlite reuses ids (after a sync, or in a new database), so a face whose encoding isn't
+    the one indexed is put in again."""
+    ids, encodings = core.load_all_encodings()
+    path = get_index_file()
+    index = None
+    if os.path.exists(path) and not rebuild:
+        index = FaceIndex.load(path)
+        if len(ids) > 2 * index.trained_size:
+            logging.info("Face library has doubled since the index was built; rebuilding it")
+            index = None
+    if index is None:
+        if len(ids) == 0: return None
+        index = FaceIndex.build(ids, encodings, lists)
+    else:
+        present = np.isin(index.ids, ids)
+        positions = np.searchsorted(ids, index.ids[present])
+        changed = np.any(np.asarray(encodings[positions]) != index.encodings[present], axis=1)
+        index.remove(np.concatenate([index.ids[~present], index.ids[present][changed]]))
+        new = ~np.isin(ids, index.ids)
+        if new.any(): index.add(ids[new], encodings[new])
+    index.save(path)
+    return index
+
+def pair_faces(threshold=0.6, nprobe=None):
+    """Like core.pair_faces_vectorised, but only compares faces in nearby buckets of the index.
+    Yields (buckets done, total buckets, pairs stored)."""
+    index = update_index()
+    if index is None: return
+    db = core.get_db()
+    c = db.cursor()
+    stored = 0
+    for done, face1s, face2s, distances in index.close_pairs(threshold, nprobe):
+        core.store_pairs(c, face1s, face2s, distances)
+        db.commit()
+        stored += len(face1s)
+        yield done, len(index.centroids), stored
+    c.execute("update faces set paired = 1 where paired = 0")
+    db.commit()
+
+class GroupCentroids:
+    """A compact summary of each group for answering "who is this?": the mean encoding of
+    the group's faces, plus a few exemplar faces (the one nearest the mean, then the ones
+    furthest from those already picked) so that groups that aren't round still match."""
+    def __init__(self, groupids, centroids, exemplar_groupids, exemplars):
+        self.groupids = groupids
+        self.centroids = centroids
+        self.exemplar_groupids = exemplar_groupids
+        self.exemplars = exemplars
+        # exemplars are stored group by group, and every group has at least one
+        self.exemplar_starts = np.searchsorted(exemplar_groupids, groupids)
+        self.centroid_squares = np.einsum("ij,ij->i", centroids, centroids)
+        self.exemplar_squares = np.einsum("ij,ij->i", exemplars, exemplars)
+
+    @classmethod
+    def build(cls, encodings, groupids, exemplars=3):
+        "encodings has one row per grouped face, and groupids the group of each row"
+        order = np.argsort(groupids, kind="stable")
+        encodings = encodings[order]
+        groupids = groupids[order]
+        unique, starts, counts = np.unique(groupids, return_index=True, return_counts=True)
+        positions = np.repeat(np.arange(len(unique)), counts)
+        centroids = np.zeros((len(unique), encodings.shape[1]))
+        for dim in range(encodings.shape[1]):
+            centroids[:, dim] = np.bincount(positions, weights=encodings[:, dim]) / counts
+        picked = []
+        for g, (start, count) in enumerate(zip(starts, counts)):
+            members = encodings[start:start + count]
+            nearest = np.linalg.norm(members - centroids[g], axis=1)
+            chosen = [int(np.argmin(nearest))]
+            spread = np.linalg.norm(members - members[chosen[0]], axis=1)
+            while len(chosen) < min(exemplars, count):
+                chosen.append(int(np.argmax(spread)))
+                spread = np.minimum(spread, np.linalg.norm(members - members[chosen[-1]], axis=1))
+            picked.extend(start + c for c in chosen)
+        return cls(unique, centroids, groupids[picked], encodings[picked])
+
+    def nearest(self, encoding, top=5, allowed=None):
+        """The top groups nearest to encoding as (group ids, distances); a group's distance is
+        to its centroid or its closest exemplar, whichever is nearer. allowed is an optional
+        boolean array over self.groupids saying which groups can be returned."""
+        square = encoding @ encoding
+        to_exemplars = self.exemplar_squares + square - 2 * (self.exemplars @ encoding)
+        d2 = np.minimum(self.centroid_squares + square - 2 * (self.centroids @ encoding),
+            np.minimum.reduceat(to_exemplars, self.exemplar_starts))
+        distances = np.sqrt(np.maximum(d2, 0))
+        candidates = np.arange(len(distances)) if allowed is None else np.nonzero(allowed)[0]
+        if len(candidates) > top:
+            candidates = candidates[np.argpartition(distances[candidates], top)[:top]]
+        candidates = candidates[np.argsort(distances[candidates])]
+        return self.groupids[candidates], distances[candidates]
+
+    def save(self, path, version):
+        np.savez(path, groupids=self.groupids, centroids=self.centroids,
+            exemplar_groupids=self.exemplar_groupids, exemplars=self.exemplars, version=version)
+
+def get_group_centroids_file():
+    return core.get_sidecar_file(".groups.npz")
+
+def load_group_centroids(exemplars=3):
+    """The group centroids saved alongside faces.db, rebuilt first if faces2groups has changed
+    since they were made. Which version they were made from is kept in the database, like
+    encodings_exported, since a new database starts counting from 0 again."""
+    db = core.get_db()
+    c = db.cursor()
+    version = core.get_groups_version(c)
+    path = get_group_centroids_file()
+    c.execute("select value from meta where key = 'group_centroids_built'")
+    built = c.fetchone()
+    if built and built[0] == version and os.path.exists(path):
+        with np.load(path) as data:
+            return GroupCentroids(data["groupids"], data["centroids"],
+                data["exemplar_groupids"], data["exemplars"])
+    ids, encodings = core.load_all_encodings()
+    c.execute("select face, groupid from faces2groups")
+    rows = np.array(c.fetchall(), dtype=np.int64).reshape(-1, 2)
+    positions = np.searchsorted(ids, rows[:, 0])
+    centroids = GroupCentroids.build(np.asarray(encodings[positions]), rows[:, 1], exemplars)
+    centroids.save(path, version)
+    c.execute("insert or replace into meta (key, value) values ('group_centroids_built', ?)", (version,))
+    db.commit()
+    return centroids
+
+def identify_image(full_path, top=5, named_only=True):
+    """Find the faces in an image and, for each, the nearest groups. Returns a list of
+    (location, [(group id, group name, distance), ...]) with one entry per face."""
+    import face_recognition
+    centroids = load_group_centroids()
+    c = core.get_db().cursor()
+    c.execute("select id, name from groups")
+    names = dict(c.fetchall())
+    allowed = None
+    if named_only:
+        allowed = np.array([names.get(g) is not None for g in centroids.groupids.tolist()], dtype=bool)
+    pixels, size = core.decode_image(core.read_image(full_path)[0])
+    locations = face_recognition.face_locations(pixels)
+    out = []
+    for location, encoding in zip(locations, face_recognition.face_encodings(pixels, known_face_locations=locations)):
+        groupids, distances = centroids.nearest(encoding, top, allowed)
+        out.append((location, [(g, names.get(g), d) for g, d in zip(groupids.tolist(), distances.tolist())]))
+    return out
@@ -6,11 +6,16 @@ from gi.repository import Gtk, GdkPixbuf, Gdk, GLib
 
 
 import core
+import facecache
+
+PREFETCH = 5 # how many groups either side of the current one to have ready
 
 class MyWindow(Gtk.Window):
     def __init__(self):
         Gtk.Window.__init__(self, title="Identify faces")
-        self.gf = core.get_groups_and_faces()
+        self.gf = facecache.GroupPages()
+        self.crops = facecache.FaceCropCache()
+        self.prefetcher = facecache.Prefetcher(self.crops)
 
         self.img = Gtk.Image()
         self.counter = Gtk.Label()
@@ -58,22 +63,17 @@ class MyWindow(Gtk.Window):
     def load(self):
         img = self.gf[self.image_index]
         self.counter.set_text("{}/{}".format(self.image_index + 1, len(self.gf)))
-        # load whole image into a pixbuf
-        pb = GdkPixbuf.Pixbuf.new_from_file(img["image"])
-        # grab the face out of it
-        face = pb.new_subpixbuf(img["x"], img["y"], img["w"], img["h"])
-        # scale that so it fits in a 400x400 box
-        if img["w"] > img["h"]:
-            scalew = 400
-            scaleh = int(img["h"] * 400.0 / img["w"])
-        else:
-            scaleh = 400
-            scalew = int(img["w"] * 400.0 / img["h"])
-        sface = face.scale_simple(scalew, scaleh, GdkPixbuf.InterpType.BILINEAR)
-        self.img.set_from_pixbuf(sface)
+        # the face, already cropped and scaled to fit in a 400x400 box
+        self.img.set_from_file(self.crops.get(img))
         gn = img.get("groupname")
         if not gn: gn = ""
         self.entry.set_text(gn)
+        # get the neighbours ready, nearest first
+        nearby = []
+        for distance in range(1, PREFETCH + 1):
+            for i in (self.image_index + distance, self.image_index - distance):
+                if 0 <= i < len(self.gf): nearby.append(self.gf[i])
+        self.prefetcher.prefetch(nearby)
 
 win = MyWindow()
 win.connect("destroy", Gtk.main_quit)
@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 "The low-level command-line interface"
-import argparse, sys
+import argparse, glob, os, shutil, subprocess, sys, time
 import core
 
 def description(desc, order):
@@ -23,36 +23,139 @@ def cmd_read_folder(folder):
     count = core.load_from_folder(folder)
     print("Read names of {} images".format(count))
 
+@description("Bring the data up to date with a folder, only analysing what has changed", 1)
+def cmd_sync(folder, threshold=0.6):
+    added, changed, removed = core.sync_folder(folder)
+    print("{} new, {} changed and {} removed images".format(added, changed, removed))
+    cmd_parse_images()
+    cmd_assign(threshold=threshold)
+    cmd_best_face()
+
 @description("Read image files from Shotwell", 1)
-def cmd_read_shotwell():
-    pass
+def cmd_read_shotwell(database=""):
+    count = core.load_from_shotwell(database or None)
+    print("Read {} images from Shotwell".format(count))
 
 @description("Analyse each image for faces", 2)
-def cmd_parse_images():
-    processed = 99
-    while processed:
-        processed, remaining = core.analyse_images_in_blocks()
-        print("Processed {} images ({} remaining)".format(processed, remaining))
+def cmd_parse_images(workers=0, in_flight=0, detect_megapixels=0.0, batch=8, encode_batch=128, model="hog", cache="yes"):
+    detect_pixels = int(detect_megapixels * 1000000) or None # 0 means detect at full resolution
+    core.metrics.start("parse-images")
+    for processed, remaining in core.analyse_images(workers or None, in_flight or None, detect_pixels=detect_pixels,
+            batch=batch, encode_batch=encode_batch, model=model, use_cache=cache == "yes"):
+        report = core.metrics.report("parse-images", processed, processed + remaining)
+        print("Processed {} images ({} remaining, {:.1f} images/sec, ETA {})".format(processed, remaining,
+            report["per_second"] or 0, core.format_eta(report["eta"])))
+
+@description("Split the images waiting to be analysed into manifests for shard-work", 2)
+def cmd_shard_plan(shards=4, folder=""):
+    for path in core.plan_shards(shards, folder or None):
+        print(path)
+
+@description("Analyse the images in one shard manifest into a shard database", 2)
+def cmd_shard_work(manifest, workers=0, batch=8, cache="yes"):
+    core.metrics.start("parse-images")
+    for processed, remaining in core.analyse_shard(manifest, workers=workers or None, batch=batch,
+            use_cache=cache == "yes"):
+        report = core.metrics.report("parse-images", processed, processed + remaining)
+        print("{}: processed {} images ({} remaining, ETA {})".format(os.path.basename(manifest), processed,
+            remaining, core.format_eta(report["eta"])))
+
+@description("Fold analysed shard databases back into the main one", 2)
+def cmd_shard_merge(folder=""):
+    for shard in sorted(glob.glob(os.path.join(folder or core.get_shard_folder(), "shard-*.db"))):
+        images, faces, skipped = core.merge_shard(shard)
+        print("{}: merged {} images with {} faces ({} skipped)".format(os.path.basename(shard), images, faces, skipped))
+
+@description("Plan, analyse and merge shards, with a process per shard on this machine", 2)
+def cmd_shard_run(shards=4, workers=0):
+    folder = core.get_shard_folder()
+    for old in glob.glob(os.path.join(folder, "shard-*")):
+        if os.path.isdir(old):
+            shutil.rmtree(old)
+        else:
+            os.unlink(old)
+    workers = workers or max(1, (os.cpu_count() or 1) // shards)
+    children = [subprocess.Popen([sys.executable, os.path.abspath(__file__), "shard-work", manifest,
+        "--workers", str(workers)]) for manifest in core.plan_shards(shards, folder)]
+    if any(child.wait() for child in children):
+        print("A shard failed; nothing was merged")
+        return
+    cmd_shard_merge(folder)
+
+@description("Convert face encodings in an older database to binary", 2)
+def cmd_migrate_encodings():
+    print("Converted {} face encodings".format(core.migrate_encodings()))
+    core.export_encodings()
 
 @description("Analyse all faces for closeness", 3)
-def cmd_pair():
-    core.insert_empty_pairs()
-    processed = 99
-    while processed:
-        processed, remaining = core.pair_faces_in_blocks()
-        print("Processed {} face pairs ({} remaining)".format(processed, remaining))
+def cmd_pair(threshold=0.6, index="no", nprobe=8):
+    import faceindex # imported here so the commands that don't use it start quicker
+    if index == "yes":
+        for done, total, stored in faceindex.pair_faces(threshold, nprobe or None):
+            print("Compared {} of {} index buckets ({} close pairs stored)".format(done, total, stored))
+        return
+    core.metrics.start("pair")
+    for done, total, stored in core.pair_faces_vectorised(threshold):
+        report = core.metrics.report("pair", done, total)
+        print("Compared {} of {} faces ({} close pairs stored, ETA {})".format(done, total, stored,
+            core.format_eta(report["eta"])))
+
+@description("Build or update the nearest-neighbour index of faces", 3)
+def cmd_index(rebuild="no"):
+    import faceindex # imported here so the commands that don't use it start quicker
+    index = faceindex.update_index(rebuild == "yes")
+    if index is None:
+        print("No faces to index")
+    else:
+        print("Indexed {} faces in {} buckets".format(len(index), len(index.centroids)))
 
 @description("Group similar faces together", 4)
-def cmd_group():
-    processed = 99
-    while processed:
-        processed, remaining = core.group_faces_in_blocks()
-        print("Assigned {} faces to groups ({} remaining)".format(processed, remaining))
+def cmd_group(distance=0.5, mode="tree"):
+    start = time.time()
+    if mode == "tree":
+        faces, groups = core.group_faces_by_cut(distance)
+        print("Grouped {} faces into {} groups".format(faces, groups))
+    elif mode == "blocks":
+        processed = 99
+        while processed:
+            processed, remaining = core.group_faces_in_blocks(distance)
+            print("Assigned {} faces to groups ({} remaining)".format(processed, remaining))
+    else:
+        pairs, groups = core.group_faces_union_find(distance)
+        print("Grouped {} close pairs into {} groups".format(pairs, groups))
+    print("Grouping took {:.2f}s".format(time.time() - start))
+
+@description("Pair and group newly analysed faces one at a time", 4)
+def cmd_assign(distance=0.5, threshold=0.6):
+    timings = []
+    for face, groupid, seconds in core.assign_new_faces(distance, threshold):
+        timings.append(seconds)
+        if groupid is None:
+            print("Face {} matched nothing ({:.1f}ms)".format(face, seconds * 1000))
+        else:
+            print("Face {} is in group {} ({:.1f}ms)".format(face, groupid, seconds * 1000))
+    if timings:
+        timings.sort()
+        print("Assigned {} faces: {:.1f}ms mean, {:.1f}ms 95th percentile".format(len(timings),
+            1000 * sum(timings) / len(timings), 1000 * timings[int(0.95 * (len(timings) - 1))]))
 
 @description("Rename a group", 5)
 def cmd_rename_group(before, after):
     pass
 
+@description("Say who is in an image, from the named groups", 6)
+def cmd_identify(image, top=5, named_only="yes"):
+    import faceindex # imported here so the commands that don't use it start quicker
+    start = time.time()
+    faces = faceindex.identify_image(image, top, named_only == "yes")
+    if not faces:
+        print("No faces found")
+    for (top_, right, bottom, left), matches in faces:
+        print("Face at {},{} ({}x{}):".format(left, top_, right - left, bottom - top_))
+        for groupid, name, distance in matches:
+            print("    {} (group {}): {:.3f}".format(name or "unnamed", groupid, distance))
+    print("Took {:.1f}ms".format((time.time() - start) * 1000))
+
 @description("Find the best face for each group", 6)
 def cmd_best_face():
     core.find_best_faces()
@@ -61,6 +164,11 @@ def cmd_best_face():
 def cmd_gallery(output):
     core.simple_gallery(output)
 
+@description("Make a gallery in a folder, with a page per group", 7)
+def cmd_paged_gallery(output_folder, page_size=200):
+    written, unchanged = core.paged_gallery(output_folder, page_size)
+    print("Wrote pages for {} groups ({} unchanged)".format(written, unchanged))
+
 @description("Do a full load, from a folder, to a gallery (losing existing data without asking)", 7)
 def cmd_all(folder, gallery_output):
     cmd_init("yes")
@@ -71,8 +179,23 @@ def cmd_all(folder, gallery_output):
     cmd_best_face()
     cmd_gallery(gallery_output)
 
+def print_profile(report):
+    print("Took {:.2f}s, peak memory {:.0f}MB".format(report["elapsed"], report["peak_rss_mb"]))
+    for name, seconds in sorted(report["seconds"].items(), key=lambda x: -x[1]):
+        calls = report["counts"].get(name, 0)
+        print("  {:<28} {:>10.3f}s {:>8} calls".format(name, seconds, calls))
+    images = report["counts"].get("images")
+    if images:
+        print("  {} images, {} faces ({} from the cache, {} copies of others)".format(images,
+            report["counts"].get("faces", 0), report["counts"].get("images.cached", 0), report["counts"].get("images.copies", 0)))
+        for name in sorted(report["seconds"]):
+            if name.startswith("image."):
+                print("  {:<28} {:>10.1f}ms per image".format(name, 1000 * report["seconds"][name] / images))
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Photo name tagger")
+    parser.add_argument("--profile", action="store_true",
+        help="Log timings to faces.profile.jsonl next to the database, and print a summary at the end")
     subparsers = parser.add_subparsers(help="commands", dest="command")
     subparsers.add_parser("help", help="This help")
 
@@ -80,8 +203,15 @@ if __name__ == "__main__":
     for name, fn in sorted(cmds.items(), key=lambda x: getattr(x[1], "__cmd_order__", 99)):
         p = subparsers.add_parser(name, help=getattr(fn, "__cmd_desc__", "(undocumented)"))
         if fn.__code__.co_varnames:
-            for a in fn.__code__.co_varnames[:fn.__code__.co_argcount]:
+            argnames = fn.__code__.co_varnames[:fn.__code__.co_argcount]
+            defaults = fn.__defaults__ or ()
+            required = len(argnames) - len(defaults)
+            for a in argnames[:required]:
                 p.add_argument(a, action="store")
+            # arguments with defaults become options, typed like their default
+            for a, default in zip(argnames[required:], defaults):
+                p.add_argument("--" + a.replace("_", "-"), dest=a, action="store", default=default,
+                    type=type(default) if default is not None else None)
 
     args = parser.parse_args()
     if args.command == "help":
@@ -89,15 +219,19 @@ if __name__ == "__main__":
         sys.exit()
 
     args = dict(args._get_kwargs())
-    cmd = args["command"]
-    del args["command"]
+    cmd = args.pop("command")
+    profile = args.pop("profile")
 
     if cmd is None:
         parser.print_help()
         sys.exit()
 
     fn = cmds[cmd]
+    if profile:
+        core.metrics.open_log(core.get_sidecar_file(".profile.jsonl"))
     fn(**args)
+    if profile:
+        print_profile(core.metrics.report(cmd))
 
 
 
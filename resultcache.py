@@ -0,0 +1,96 @@
+"Analysis results kept by the md5 of the photo, so copies of a photo are only analysed once"
+import json
+import sqlite3
+import time
+
+# bumped whenever the tables change; a cache file from another version is just emptied
+VERSION = 1
+
+class ResultCache:
+    """What analysing a photo found (its size, thumbnail, and the locations, encodings and crops
+    of its faces) keyed by the md5 of its bytes and the settings it was analysed with, since
+    detecting at another resolution or with another model finds different faces. Only entries
+    with this cache's settings are seen. It's a file of its own, so several databases can share
+    one, and once it holds more than max_bytes the entries used least recently are dropped.
+    size and prehash are kept so callers can tell cheaply which files might be in it."""
+    def __init__(self, path, settings="", max_bytes=1024 * 1024 * 1024):
+        self.settings = settings
+        self.max_bytes = max_bytes
+        self.db = sqlite3.connect(path, timeout=60) # shard workers may share one
+        self.db.execute("pragma journal_mode = wal")
+        if self.db.execute("pragma user_version").fetchone()[0] != VERSION:
+            self.db.execute("drop table if exists results")
+            self.db.execute("drop table if exists crops")
+            self.db.execute("pragma user_version = {}".format(VERSION))
+        self.db.execute("""create table if not exists results (md5 text, settings text, size int, prehash text,
+            width int, height int, locations text, encodings blob, thumbnail text, bytes int, used real,
+            primary key (md5, settings))""")
+        self.db.execute("create index if not exists idx_results_prehash on results (prehash)")
+        self.db.execute("""create table if not exists crops (md5 text, settings text, face int, data blob,
+            primary key (md5, settings, face))""")
+        self.db.commit()
+        self.total = None
+
+    def sizes(self):
+        "The file sizes of everything in the cache"
+        return set(x[0] for x in self.db.execute("select distinct size from results where settings = ?",
+            (self.settings,)))
+
+    def has_prehash(self, prehash):
+        return self.db.execute("select 1 from results where prehash = ? and settings = ?",
+            (prehash, self.settings)).fetchone() is not None
+
+    def has(self, md5):
+        return self.db.execute("select 1 from results where md5 = ? and settings = ?",
+            (md5, self.settings)).fetchone() is not None
+
+    def get(self, md5):
+        "(width, height, locations, encodings, thumbnail, crops) for a photo, or None"
+        key = (md5, self.settings)
+        row = self.db.execute("""select width, height, locations, encodings, thumbnail from results
+            where md5 = ? and settings = ?""", key).fetchone()
+        if not row: return None
+        import numpy as np
+        width, height, locations, encodings, thumbnail = row
+        self.db.execute("update results set used = ? where md5 = ? and settings = ?", (time.time(),) + key)
+        self.db.commit()
+        locations = [tuple(x) for x in json.loads(locations)]
+        encodings = list(np.frombuffer(encodings, dtype=np.float64).reshape(-1, 128))
+        crops = [x[0] for x in self.db.execute("select data from crops where md5 = ? and settings = ? order by face", key)]
+        return width, height, locations, encodings, thumbnail, crops
+
+    def put_many(self, entries):
+        "Store (md5, size, prehash, width, height, locations, encodings, thumbnail, crops) entries"
+        import numpy as np
+        now = time.time()
+        rows = []
+        crops = []
+        for md5, size, prehash, width, height, locations, encodings, thumbnail, face_crops in entries:
+            blob = np.asarray(encodings, dtype=np.float64).tobytes()
+            nbytes = len(blob) + sum(len(c) for c in face_crops) + 200
+            rows.append((md5, self.settings, size, prehash, width, height, json.dumps(locations), blob, thumbnail,
+                nbytes, now))
+            crops.extend((md5, self.settings, face, data) for face, data in enumerate(face_crops))
+        self.db.executemany("insert or replace into results values (?,?,?,?,?,?,?,?,?,?,?)", rows)
+        self.db.executemany("insert or replace into crops values (?,?,?,?)", crops)
+        self.db.commit()
+        if self.total is not None:
+            self.total += sum(row[9] for row in rows)
+        self.trim()
+
+    def trim(self):
+        "Drop the least recently used entries, if need be, to get back under max_bytes"
+        # the running total is only an estimate, since others may share the file; it's checked before trimming
+        if self.total is not None and self.total <= self.max_bytes: return
+        self.total = self.db.execute("select coalesce(sum(bytes), 0) from results").fetchone()[0]
+        if self.total <= self.max_bytes: return
+        target = self.total - int(self.max_bytes * 0.9) # leave some room, so we don't trim on every put
+        dropped = []
+        for md5, settings, nbytes in self.db.execute("select md5, settings, bytes from results order by used").fetchall():
+            if target <= 0: break
+            dropped.append((md5, settings))
+            target -= nbytes
+            self.total -= nbytes
+        self.db.executemany("delete from results where md5 = ? and settings = ?", dropped)
+        self.db.executemany("delete from crops where md5 = ? and settings = ?", dropped)
+        self.db.commit()